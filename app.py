@@ -2,6 +2,7 @@ import dash
 from dash import dcc
 from dash import html
 from dash.dependencies import Input, Output, State
+from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
 from dash import dash_table
 
@@ -16,13 +17,25 @@ import csv
 import math
 import random
 import timeit
+import uuid
+import json
+import flask
 
 import urllib
 import numpy as np
-import statsmodels.api as sm
 from scipy import stats
-from sklearn.preprocessing import PolynomialFeatures
-from statsmodels.stats.outliers_influence import summary_table
+
+from archive import data_source, load_column_schema
+from datasets import (DATE_COL, NAME_COL, column_manifest, feature_column, get_dataset, load_partitions,
+                      manifest_columns, numeric_values)
+from export import EXPORT_FORMATS, export_chunks, export_size, parse_cms_list, size_text
+from figures import cached_figure
+from jobs import load_progress_text, long_callback_manager
+from regression import fit_polynomial
+from sampling import PLOT_GL_POINTS, PLOT_MAX_POINTS, downsample, thin
+from scales import AXIS_SCALES, scale_axes
+from directory import (GENDAT_PATH, HospitalFilter, HospitalSearch, clean_hospital_directory, load_hospital_directory,
+                       read_name_aliases)
 
 px.set_mapbox_access_token('pk.eyJ1Ijoia2xvY2V5IiwiYSI6ImNrYm9uaWhoYjI0ZDcycW56ZWExODRmYzcifQ.Mb27BYst186G4r5fjju6Pw')
 
@@ -38,7 +51,7 @@ pd.set_option('display.max_columns', None)
 external_stylesheets=[dbc.themes.BOOTSTRAP, FONT_AWESOME, 'https://codepen.io/chriddyp/pen/bWLwgP.css']
 app = dash.Dash(__name__, 
                 external_stylesheets = external_stylesheets,
-                #long_callback_manager = long_callback_manager,
+                long_callback_manager = long_callback_manager,
                 )
 
 app.config.suppress_callback_exceptions = True
@@ -46,41 +59,32 @@ server = app.server
 
 ################################# LOAD DATA ##################################
 
-gendat_df = pd.read_pickle('dataframe_data/GenDat4App.pkl')
-
-gendat_df = gendat_df[~gendat_df['Name and Num'].isin([np.nan, float('NaN')])]
-gendat_df['State'] = gendat_df['State'].replace(np.nan, 'Not given')
-gendat_df['Hospital Type'] = gendat_df['Hospital Type'].replace(np.nan, 'Not given')
-gendat_df['Hospital Ownership'] = gendat_df['Hospital Ownership'].replace(np.nan, 'Not given')
-
-gendat_df.loc[gendat_df['Name and Num'] == ' HIMA SAN PABLO BAYAMON (400109)', 'Name and Num'] = 'HIMA SAN PABLO BAYAMON (400109)'
-gendat_df.loc[gendat_df['Name and Num'] == ' KETCHIKAN MEDICAL CENTER (021311)', 'Name and Num'] = 'KETCHIKAN MEDICAL CENTER (021311)'
-gendat_df.loc[gendat_df['Name and Num'] == '(CLOSED) CUMBERLAND RIVER HOSPITAL (441319)', 'Name and Num'] = 'CUMBERLAND RIVER HOSPITAL (441319)'
-gendat_df.loc[gendat_df['Name and Num'] == '1st Medical Group (Langley AFB) (49005F)', 'Name and Num'] = 'Langley AFB (49005F)'
-gendat_df.loc[gendat_df['Name and Num'] == '60th Medical Group (Travis AFB) (05015F)', 'Name and Num'] = 'Langley AFB (49005F)'
-gendat_df.loc[gendat_df['Name and Num'] == '633rd Medical Group (Joint Base Langley-Eustis) (49005F)', 'Name and Num'] = 'Langley AFB (49005F)'
-gendat_df.loc[gendat_df['Name and Num'] == '673rd Medical Group (Joint Base Elmendorf-Richardson) (02013F)', 'Name and Num'] = 'Elmendorf-Richardson Joint Base (02013F)'
-gendat_df.loc[gendat_df['Name and Num'] == '81st Medical Group (Keesler AFB) (25039F)', 'Name and Num'] = 'Keesler AFB (25039F)'
-gendat_df.loc[gendat_df['Name and Num'] == '88th Medical Group (Wright-Patterson AFB) (36006F)', 'Name and Num'] = 'Wright-Patterson AFB (36006F)'
-gendat_df.loc[gendat_df['Name and Num'] == '96th Medical Group (Eglin AFB) (10021F)', 'Name and Num'] = 'Eglin AFB (10021F)'
-gendat_df.loc[gendat_df['Name and Num'] == '99th Medical Group (Nellis AFB) (29001F)', 'Name and Num'] = 'Nellis AFB (29001F)'
+# The cleaned hospital directory is built offline (python build_data.py directory)
+try:
+    gendat_df = load_hospital_directory()
+except (OSError, ValueError) as e:
+    print('Could not load hospital directory:', e)
+    gendat_df = clean_hospital_directory(pd.read_pickle(GENDAT_PATH), read_name_aliases())
 
 ######################## SELECTION LISTS #####################################
 
-HOSPITALS = gendat_df['Name and Num'].tolist()
-beds = gendat_df['Beds'].tolist()
-
-states = gendat_df['State'].tolist()
-htypes = gendat_df['Hospital Type'].tolist()
-ctypes = gendat_df['Hospital Ownership'].tolist()
-lons = gendat_df['Lon'].tolist()
-lats = gendat_df['Lat'].tolist()
+# Reference data are kept in NumPy arrays (of fixed-width strings and numbers)
+# instead of lists of Python objects. When gunicorn preloads the app (see
+# gunicorn.conf.py), reading these arrays does not touch reference counts, so
+# forked workers keep sharing their memory pages with the master process.
+HOSPITALS = gendat_df['Name and Num'].to_numpy(dtype=str)
+beds = gendat_df['Beds'].to_numpy()
 
-states = ['NaN' if x is np.nan else x for x in states]
-htypes = ['NaN' if x is np.nan else x for x in htypes]
-ctypes = ['NaN' if x is np.nan else x for x in ctypes]
+states = gendat_df['State'].to_numpy(dtype=str)
+htypes = gendat_df['Hospital Type'].to_numpy(dtype=str)
+ctypes = gendat_df['Hospital Ownership'].to_numpy(dtype=str)
+lons = gendat_df['Lon'].to_numpy()
+lats = gendat_df['Lat'].to_numpy()
 
-HOSPITALS_SET = sorted(list(set(HOSPITALS)))
+HOSPITAL_FILTER = HospitalFilter(HOSPITALS, beds, states, htypes, ctypes)
+HOSPITAL_SEARCH = HospitalSearch(HOSPITAL_FILTER.names)
+CMS_COUNT = len(gendat_df['Facility ID'].unique())
+del gendat_df
 
 ddfs = "100%"
 
@@ -104,14 +108,23 @@ sub_categories.remove('HAC, Fiscal Year')
 sub_categories.remove('file date, file date')
 sub_categories.sort()
 
-url = 'https://raw.githubusercontent.com/Rush-Quality-Analytics/hospitals-data-archive/main/hospital_files/010001.csv'
-
-main_df = pd.read_csv(url, index_col=[0], header=[0, 1])
-main_df = pd.DataFrame(columns = main_df.columns)
+# The (category, sub-category) columns of the hospital files are read from a
+# bundled manifest, so starting the app does not need the data archive.
+# Rebuild the manifest with `python build_data.py schema`.
+try:
+    main_df = pd.DataFrame(columns = load_column_schema())
+except (OSError, ValueError) as e:
+    print('Could not load column schema:', e)
+    main_df = data_source.read('010001')
+    main_df = pd.DataFrame(columns = main_df.columns)
 
 print(main_df.shape[1], 'features')
-print(len(gendat_df['Facility ID'].unique()), 'CMS numbers')
-print(len(list(set(HOSPITALS))), 'hospitals')
+
+# Column names in the order of the bits of column manifests (see datasets.py)
+SCHEMA_COLUMNS = [str(c) for c in main_df.columns]
+SCHEMA_PAIRS = {str(c): c for c in main_df.columns if isinstance(c, tuple)}
+print(CMS_COUNT, 'CMS numbers')
+print(len(HOSPITAL_FILTER.names), 'hospitals')
 
 random.seed(42)
 
@@ -122,6 +135,13 @@ for h in HOSPITALS:
     else:
         clr = '#' + "%06x" % random.randint(0, 0xFFFFFF)
     COLORS.append(clr)
+COLORS = np.array(COLORS)
+
+# Rows of HOSPITALS sorted by name, for finding the row of a hospital's name
+# in HOSPITALS, COLORS and the other reference arrays by binary search. The
+# sort is stable, so a name that occurs more than once is found at its first row.
+HOSPITAL_ORDER = np.argsort(HOSPITALS, kind='stable')
+SORTED_HOSPITALS = HOSPITALS[HOSPITAL_ORDER]
     
 
 print(len(sub_categories), 'choosable features')
@@ -133,6 +153,129 @@ def obs_pred_rsquare(obs, pred):
     return r2
     
 
+def hospital_rows(hospitals):
+    """
+    :return: An array of the indices of hospital names in HOSPITALS (and
+             COLORS). Raises KeyError for a name that is not in HOSPITALS.
+    """
+    
+    hospitals = np.asarray(hospitals, dtype=str)
+    i = np.searchsorted(SORTED_HOSPITALS, hospitals)
+    found = i < len(SORTED_HOSPITALS)
+    found[found] = SORTED_HOSPITALS[i[found]] == hospitals[found]
+    if not found.all():
+        raise KeyError(hospitals[~found][0])
+    return HOSPITAL_ORDER[i]
+
+
+def hospital_index(hospital):
+    """
+    :return: The index of a hospital's name in HOSPITALS (and COLORS).
+    """
+    
+    return hospital_rows([hospital])[0]
+
+
+def split_by_hospital(df, hospitals, by=None):
+    """
+    Sort df once by hospital name and file date (or the columns in by) and
+    split it by hospital, so traces can be built without scanning df for each
+    hospital.
+    
+    :return: A list of the DataFrames of the hospitals in hospitals, each sorted
+             by file date or by (and empty for a hospital without data in df).
+    """
+    
+    if by is None:
+        by = [DATE_COL]
+    df = df.sort_values(by=[NAME_COL] + by, kind='mergesort')
+    names = df[NAME_COL].to_numpy()
+    
+    starts = np.flatnonzero(np.r_[True, names[1:] != names[:-1]]) if len(names) > 0 else []
+    stops = np.r_[starts[1:], len(names)] if len(names) > 0 else []
+    rows = {names[a]: (a, b) for a, b in zip(starts, stops)}
+    
+    return [df.iloc[slice(*rows.get(h, (0, 0)))] for h in hospitals]
+
+
+def hospital_scatter_traces(sdf, focal_h=None):
+    """
+    Build the points of a large scatter plot as WebGL traces. Hospitals other
+    than focal_h share one trace, with a color per point (gray when there is a
+    focal hospital) and the hospital and file date in the hover text. Only a
+    sample of their points is drawn (see sampling.downsample); all points of
+    focal_h are drawn, in a trace of its own.
+
+    :return: A list of traces for the points in sdf (columns x, y, file date
+             and hospital name).
+    """
+
+    focal = (sdf[NAME_COL] == focal_h).to_numpy()
+    shown = downsample(sdf['x'], sdf['y'], PLOT_MAX_POINTS, keep=focal) & ~focal
+    hover = '%{customdata[0]}<br>%{customdata[1]}<br>(%{x}, %{y})<extra></extra>'
+
+    others = sdf[shown]
+    if focal_h is None:
+        codes, names = pd.factorize(others[NAME_COL])
+        clr = COLORS[hospital_rows(names)][codes]
+    else:
+        clr = '#b3b3b3'
+
+    traces = [go.Scattergl(
+                x=others['x'].to_numpy(),
+                y=others['y'].to_numpy(),
+                name=str(sdf.loc[~focal, NAME_COL].nunique()) + ' hospitals',
+                mode='markers',
+                marker=dict(color=clr),
+                customdata=np.stack([others[NAME_COL].astype(str), others[DATE_COL].astype(str)], axis=-1),
+                hovertemplate=hover,
+            )]
+
+    if focal_h is not None:
+        tdf = sdf[focal]
+        name = focal_h
+        if len(name) > 30:
+            name = name[0:20] + ' ... ' + name[-8:]
+        traces.append(go.Scattergl(
+                x=tdf['x'].to_numpy(),
+                y=tdf['y'].to_numpy(),
+                name=name,
+                mode='markers',
+                marker=dict(color=COLORS[hospital_index(focal_h)]),
+                customdata=np.stack([tdf[NAME_COL].astype(str), tdf[DATE_COL].astype(str)], axis=-1),
+                hovertemplate=hover,
+            ))
+
+    return traces
+
+
+def sub_category_options(category, data=None):
+    """
+    :return: Dropdown options for the sub-categories of a category. If data (a
+             df_tab1 handle) is given, only sub-categories that have data for
+             any of its hospitals are included.
+    """
+    
+    in_category = main_df.columns.get_level_values(0) == category
+    if data is not None:
+        in_category &= manifest_columns(data['columns'], SCHEMA_COLUMNS)
+    
+    sub_cat = main_df.columns.get_level_values(1)[in_category].tolist()
+    sub_cat = [c for c in sub_cat if c not in ['Fiscal Year', 'file date']]
+    
+    return [{"label": i, "value": i} for i in sub_cat]
+
+
+def failed_text(failed):
+    """
+    :return: Text listing the CMS numbers of hospitals whose files could not be loaded.
+    """
+    if len(failed) == 0:
+        return ""
+    
+    return ", " + str(len(failed)) + " failed (" + ", ".join(failed) + ")"
+
+
 
 def description_card1():
     """
@@ -334,13 +477,14 @@ def generate_control_card1():
                 ),
             dbc.Modal(
                 [dbc.ModalBody([
-                                html.P("This app returns data for the hospitals you choose and for any hospitals with matching CMS numbers. Note: If you are using the web-application, do not load more than 20 hospitals at a time. Otherwise, the application may timeout.",
+                                html.P("This app returns data for the hospitals you choose and for any hospitals with matching CMS numbers. Note: Loading many hospitals can take a few minutes. Progress is shown below the button that loads the data.",
                                        style={'font-size': 16,}),
                                 dcc.Dropdown(
                                     id="hospital-select1",
-                                    options=[{"label": i, "value": i} for i in HOSPITALS_SET],
+                                    options=[],
                                     multi=True,
                                     value=None,
+                                    placeholder="Type a hospital name or CMS number",
                                     optionHeight=50,
                                     style={
                                         'font-size': 14,
@@ -388,7 +532,10 @@ def generate_control_card1():
                            },
                 ),
             
-            html.Br(),
+            html.P(id="text1-progress", style={'fontSize':12,
+                                               'textAlign': 'center',
+                                               'margin-top': '10px',
+                                               }),
             html.Br(),
             html.Hr(),
             dcc.Loading(
@@ -413,12 +560,30 @@ def generate_control_card1():
                             },
                         ),
                     
-                    html.Button("Download data", id="download-btn",
-                        style={'width': '80%',
-                            'margin-left': '10%',
-                            },
+                    # The download is a form post, so the browser saves the
+                    # file as the server streams it (see download_data)
+                    html.Form(
+                        [dcc.Input(id="download-cms", type="hidden", name="cms"),
+                         dcc.Dropdown(
+                            id="download-format",
+                            options=[{"label": v[0], "value": k} for k, v in EXPORT_FORMATS.items()],
+                            value="data.csv",
+                            clearable=False,
+                            style={'width': '80%',
+                                'margin-left': '10%',
+                                'font-size': 16,
+                                },
+                            ),
+                         html.Button("Download data", id="download-btn", type="submit",
+                            style={'width': '80%',
+                                'margin-left': '10%',
+                                },
+                            ),
+                         ],
+                        id="download-form",
+                        action="/download/data.csv",
+                        method="post",
                         ),
-                    dcc.Download(id="data-download"),
                     
                     html.Br(),
                     html.Br(),
@@ -471,7 +636,7 @@ def generate_control_card3():
             
             dcc.Dropdown(
                     id='x_transform',
-                    options=[{"label": i, "value": i} for i in ['linear', 'log10', 'square root']],
+                    options=[{"label": i, "value": i} for i in AXIS_SCALES],
                     multi=False, value='linear',
                     style={'width': '120px', 
                             'font-size': 13,
@@ -515,7 +680,7 @@ def generate_control_card3():
             
             dcc.Dropdown(
                     id='y_transform',
-                    options=[{"label": i, "value": i} for i in ['linear', 'log10', 'square root']],
+                    options=[{"label": i, "value": i} for i in AXIS_SCALES],
                     multi=False, value='linear',
                     style={'width': '120px', 
                             'font-size': 13,
@@ -701,6 +866,8 @@ def generate_control_card5():
 app.layout = html.Div([
     
     dcc.Store(id='df_tab1', storage_type='memory'),
+    dcc.Store(id='df_loaded', storage_type='memory'),
+    dcc.Store(id='df_partial', storage_type='memory'),
     
     html.Div(
         id='url_ls',
@@ -987,49 +1154,7 @@ def update_output1(value):
     )
 def update_output3(value, df):
     
-    df2 = main_df.iloc[:, (main_df.columns.get_level_values(0)==value)]
-    sub_cat = df2.columns.get_level_values(1).tolist()
-    
-    try:
-        sub_cat.remove('Fiscal Year')
-    except:
-        pass
-    try:
-        sub_cat.remove('file date')
-    except:
-        pass
-    
-    del df2
-    
-    if df is not None:
-        
-        df = pd.read_json(df)
-        df.dropna(axis=1, how='all', inplace=True)
-        cols1 = list(df)
-        cols2 = []
-        for c in cols1:
-            s = c.split("', ")[-1]
-            s = s[1:-2]
-            cols2.append(s)
-            
-        sub_categories = []
-        for c in sub_cat:
-            if c in cols2:
-                sub_categories.append(c)
-    
-    else:
-        sub_categories = sub_cat
-    
-    try:
-        sub_categories.remove('Fiscal Year')
-    except:
-        pass
-    try:
-        sub_categories.remove('file date')
-    except:
-        pass
-    
-    return [{"label": i, "value": i} for i in sub_categories]
+    return sub_category_options(value, df)
 
 
 @app.callback( # Select sub-category
@@ -1049,27 +1174,28 @@ def update_output4(available_options):
 @app.callback(
     Output("hospital-select1", 'options'),
     [
+     Input("hospital-select1", "search_value"),
      Input('beds1', 'value'),
      Input('states-select1', 'value'),
      Input('hospital_type1', 'value'),
      Input('control_type1', 'value'),
      ],
+    [State("hospital-select1", "value")],
     )
-def update_hospitals(bed_range, states_vals, htype_vals, ctype_vals):
-    
-    low, high = bed_range
-    hospitals = []
-    for i, h in enumerate(HOSPITALS):
-        b = beds[i]
-        s = states[i]
-        ht = htypes[i]
-        ct = ctypes[i]
-        if b > low and b < high:
-            if s in states_vals and ht in htype_vals:
-                if ct in ctype_vals:
-                    hospitals.append(h)
-            
-    hospitals = sorted(list(set(hospitals)))
+def update_hospitals(search_value, bed_range, states_vals, htype_vals, ctype_vals, selected):
+    
+    # Only the best matches to the search text are sent to the browser. The set
+    # of hospitals that pass the filters stays on the server (see get_urls).
+    allowed = HOSPITAL_FILTER.select_ids(bed_range, states_vals, htype_vals, ctype_vals)
+    hospitals = HOSPITAL_SEARCH.search(search_value, allowed)
+    
+    # Selected hospitals are kept as options, or the dropdown would drop them
+    if selected is None:
+        selected = []
+    elif isinstance(selected, str) == True:
+        selected = [selected]
+    hospitals = selected + [h for h in hospitals if h not in selected]
+    
     return [{"label": i, "value": i} for i in hospitals]
 
 
@@ -1081,14 +1207,14 @@ def update_hospitals(bed_range, states_vals, htype_vals, ctype_vals):
      ],
     [Input('btn1', 'n_clicks')],
     [State("hospital-select1", "value"),
-     State("hospital-select1", "options"),],
+     State('beds1', 'value'),
+     State('states-select1', 'value'),
+     State('hospital_type1', 'value'),
+     State('control_type1', 'value'),],
     )
-def get_urls(btn1, hospitals, hospital_options):
+def get_urls(btn1, hospitals, bed_range, states_vals, htype_vals, ctype_vals):
     
-    options = []
-    for h in hospital_options:
-        h1 = list(h.values())
-        options.append(h1[0])
+    options = HOSPITAL_FILTER.select(bed_range, states_vals, htype_vals, ctype_vals)
     
     if hospitals is None or hospitals == []:
         ls1 = [{"label": i, "value": i} for i in ['No focal hospital']]
@@ -1103,95 +1229,98 @@ def get_urls(btn1, hospitals, hospital_options):
         ls1 = [{"label": i, "value": i} for i in ['No focal hospital']]
         return None, ls1, ls1, ls1
     
-    url_ls = []
+    # CMS numbers of the selected hospitals. These are resolved to files by the
+    # data source (see archive.py) when the data are loaded.
+    cms_ls = []
     for i, val in enumerate(hospitals):
         
         val = val[-9:]
         prvdr = re.sub('\ |\?|\.|\!|\/|\;|\:', '', val)
         prvdr = prvdr[prvdr.find("(")+1:prvdr.find(")")]
-        
-        url = 'https://raw.githubusercontent.com/Rush-Quality-Analytics/hospitals-data-archive/main/hospital_files/' + prvdr + '.csv'
-        url_ls.append(url)
+        cms_ls.append(prvdr)
     
     #txt = ', ' + str(len(hospitals)) + ' selected'
     hospitals = ['No focal hospital'] + hospitals
     ls1 = [{"label": i, "value": i} for i in hospitals]
     
-    return url_ls, ls1, ls1, ls1
+    return cms_ls, ls1, ls1, ls1
+    
+
+def loaded_dataset(parts, failed=()):
+    """
+    :return: The df_tab1 handle of the dataset made of the hospital partitions
+             in parts (see datasets.py) and the text reporting how many
+             hospitals were loaded.
+    """
+    
+    handle = {'id': uuid.uuid4().hex,
+              'cms': list(parts),
+              'columns': column_manifest(parts.values(), SCHEMA_COLUMNS),
+              'rows': sum([len(p) for p in parts.values()]),
+              }
+    num_h = sum([p.shape[0] > 0 for p in parts.values()])
+    
+    return handle, ", " + str(num_h) + " Loaded" + failed_text(failed)
+
+
+@app.long_callback(
+    Output('df_loaded', "data"),
+    [Input('url_ls', 'children')],
+    progress=[Output("text1-progress", 'children'),
+              Output('df_partial', "data")],
+    progress_default=["", None],
+    running=[(Output('btn1', 'disabled'), True, False)],
+    # A load of hospitals that are no longer selected is stopped
+    cancel=[Input("hospital-select1", "value")],
+    )
+def update_df1_tab1(set_progress, cms_ls):
+    
+    if cms_ls is None or cms_ls is []:
+        return [None, ""]
+    
+    # The hospitals loaded so far are published as they arrive (df_partial),
+    # so the map and plots can be used before the last hospital is read.
+    # Progress values are replaced rather than queued, so each one carries the
+    # latest partial dataset.
+    latest = [None, None]
+    
+    def progress(done, total):
+        latest[0] = load_progress_text(done, total)
+        set_progress(latest)
+    
+    def partial(parts):
+        latest[1] = list(loaded_dataset(parts))
+        set_progress(latest)
+    
+    # Hospitals already loaded by any dataset are not read again
+    parts, failed = load_partitions(cms_ls, progress=progress, partial=partial)
+    if len(parts) == 0:
+        return [None, failed_text(failed)]
     
+    return list(loaded_dataset(parts, failed))
+
 
 @app.callback(
     [Output('df_tab1', "data"),
      Output("text1", 'children'),],
-    [
-     Input('url_ls', 'children'),
-     Input('df_tab1', "data"),
-     ],
+    [Input('df_loaded', "data"),
+     Input('df_partial', "data")],
+    [State('df_tab1', "data")],
     )
-def update_df1_tab1(urls, df):
+def update_df_tab1(loaded, partial, data):
+    
+    # The handle and text of the last dataset loaded, or of the hospitals
+    # loaded so far while a load is running
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+    if 'df_loaded.data' not in triggered:
+        if partial is None or data is not None and partial[0]['id'] == data['id']:
+            raise PreventUpdate
+        loaded = partial
     
-    if urls is None or urls is []:
+    if loaded is None:
         return None, ""
     
-    elif df is None:
-        
-        for i, url in enumerate(urls):
-            
-            tdf = pd.read_csv(url, header=[0,1], index_col=[0])
-            tdf[('data url', 'data url')] = [url] * tdf.shape[0]
-            
-            if i == 0:
-                df = tdf.copy(deep=True)
-            else:
-                df = pd.concat([df, tdf]) 
-        
-        df.dropna(axis=1, how='all', inplace=True)
-        df.reset_index(drop=True, inplace=True)
-        
-        df = df[~df[('Name and Num', 'Name and Num')].isin([np.nan, float('NaN'), None])]
-        df = df.replace({None: np.nan})
-        df = df.replace({'Not Available': np.nan})
-        
-        num_h = len(df[('Facility ID', 'Facility ID')].unique())
-        return df.to_json(), ", " + str(num_h) + " Loaded"
-
-    else:
-        df = pd.read_json(df)
-        
-        df = df[df["('data url', 'data url')"].isin(urls)]
-        df_urls = df["('data url', 'data url')"].unique()
-        
-        url_ls = list(set(urls)-set(df_urls))
-        
-        if len(url_ls) > 0:
-            df2 = 0
-            for i, url in enumerate(url_ls):
-                
-                tdf = pd.read_csv(url, header=[0,1], index_col=[0])
-                tdf[('data url', 'data url')] = [url] * tdf.shape[0]
-                
-                if i == 0:
-                    df2 = tdf.copy(deep=True)
-                else:
-                    df2 = pd.concat([df2, tdf]) 
-            
-            df2.reset_index(inplace=True)
-            df2 = df2.to_json()
-            df2 = pd.read_json(df2)
-            df = pd.concat([df, df2])
-            del df2
-        
-        df.dropna(axis=1, how='all', inplace=True)
-        df.reset_index(drop=True, inplace=True)
-        
-        x = "('Name and Num', 'Name and Num')"
-        df = df[~df[x].isin([np.nan, float('NaN'), None])]
-        df = df.replace({None: np.nan})
-        df = df.replace({'Not Available': np.nan})
-        
-        num_h = len(df["('Name and Num', 'Name and Num')"].unique())
-        
-        return df.to_json(), ", " + str(num_h) + " Loaded"
+    return loaded[0], loaded[1]
 
 
 @app.callback(
@@ -1201,6 +1330,7 @@ def update_df1_tab1(urls, df):
      [State("hospital-select1", "value")],
      ],
     )
+@cached_figure(dataset_arg=0, ignore_args=(1,))
 def update_map_plot1(df, h):
     
     figure = go.Figure()
@@ -1229,20 +1359,22 @@ def update_map_plot1(df, h):
         margin={"r":0,"t":0,"l":0,"b":0},
         )
 
+    df = get_dataset(df, columns=[])
     if df is None:
         return figure#, ', 0 Selected'
     
-    df = pd.read_json(df)
     
     h = df["('Name and Num', 'Name and Num')"].unique()
     
-    tdf = gendat_df[gendat_df['Name and Num'].isin(h)]
+    # Names as a fixed-width string array like HOSPITALS: comparing against an
+    # object array falls back to one pass over HOSPITALS per name
+    hi = np.isin(HOSPITALS, h.astype(str))
     
     figure = go.Figure()
     figure.add_trace(go.Scattermapbox(
-        lon = tdf['Lon'],
-        lat = tdf['Lat'],
-        text = tdf['Name and Num'],
+        lon = lons[hi],
+        lat = lats[hi],
+        text = HOSPITALS[hi],
                
         marker = dict(
             size = 10,
@@ -1279,33 +1411,50 @@ def update_map_plot1(df, h):
 
 
 @app.callback(
-    Output("data-download", "data"),
-    Input("download-btn", "n_clicks"),
-    [State('df_tab1', "data")],
-    prevent_initial_call=True,
+    [Output("download-cms", "value"),
+     Output("download-form", "action")],
+    [Input('df_tab1', "data"),
+     Input("download-format", "value")],
 )
-def update_download(n_clicks, df):
+def update_download(df, name):
     
+    # The download form posts the CMS numbers of the loaded hospitals to the
+    # chosen file
+    action = "/download/" + name
     if df is None:
-        return dcc.send_data_frame(main_df.to_csv, "data.csv")
-            
-    df = pd.read_json(df)
-    if df.shape[0] == 0:
-        return dcc.send_data_frame(main_df.to_csv, "data.csv")
-        
-    else:
-        tdf = main_df.copy(deep=True)
-        cols = list(df)
-        
-        for i, c in enumerate(cols):
-            vals = df[c].tolist()
-            
-            c = list(eval(c))
-            tdf[(c[0], c[1])] = vals
+        return '', action
     
-    return dcc.send_data_frame(tdf.to_csv, "data.csv")
+    return json.dumps(df['cms']), action
+
+
+@app.long_callback(
+    Output("download-btn", "children"),
+    [Input('df_tab1', "data"),
+     Input("download-format", "value")],
+    )
+def update_download_size(df, name):
     
+    # The button shows the file's expected size. The estimate encodes a few of
+    # the hospitals (see export_size), so it runs as a job; a job for a
+    # dataset or format that has since changed is stopped.
+    if df is None:
+        return "Download data"
+    
+    size = export_size(name, df['cms'], df['rows'], SCHEMA_COLUMNS, SCHEMA_PAIRS)
+    return "Download data (about " + size_text(size) + ")"
 
+
+@server.route('/download/<name>', methods=['POST'])
+def download_data(name):
+    
+    # The file is encoded and sent a batch of hospitals at a time
+    if name not in EXPORT_FORMATS:
+        flask.abort(404)
+    
+    cms_ls = parse_cms_list(flask.request.form.get('cms'))
+    chunks = export_chunks(name, cms_ls, SCHEMA_COLUMNS, SCHEMA_PAIRS)
+    return flask.Response(flask.stream_with_context(chunks), mimetype=EXPORT_FORMATS[name][1],
+                          headers={'Content-Disposition': 'attachment; filename=' + name})
     
 
 @app.callback( # Update available sub_categories
@@ -1317,49 +1466,7 @@ def update_download(n_clicks, df):
     )
 def update_output7(value, df):
     
-    df2 = main_df.iloc[:, (main_df.columns.get_level_values(0)==value)]
-    sub_cat = df2.columns.get_level_values(1).tolist()
-    
-    try:
-        sub_cat.remove('Fiscal Year')
-    except:
-        pass
-    try:
-        sub_cat.remove('file date')
-    except:
-        pass
-    
-    del df2
-    
-    if df is not None:
-        df = pd.read_json(df)
-        df.dropna(how='all', axis=1, inplace=True)
-        
-        cols1 = list(df)
-        cols2 = []
-        for c in cols1:
-            s = c.split("', ")[-1]
-            s = s[1:-2]
-            cols2.append(s)
-            
-        sub_categories = []
-        for c in sub_cat:
-            if c in cols2:
-                sub_categories.append(c)
-    else:
-        sub_categories = sub_cat
-    
-    try:
-        sub_categories.remove('Fiscal Year')
-    except:
-        pass
-    try:
-        sub_categories.remove('file date')
-    except:
-        pass
-    
-    return [{"label": i, "value": i} for i in sub_categories]
-
+    return sub_category_options(value, df)
 
 
 @app.callback( # Select sub-category
@@ -1384,50 +1491,8 @@ def update_output8(available_options):
      ],
     )
 def update_output9(value, df):
-
-    df2 = main_df.iloc[:, (main_df.columns.get_level_values(0)==value)]
-    sub_cat = df2.columns.get_level_values(1).tolist()
-    
-    try:
-        sub_cat.remove('Fiscal Year')
-    except:
-        pass
-    try:
-        sub_cat.remove('file date')
-    except:
-        pass
-    
-    del df2
-    
-    if df is not None:
-        df = pd.read_json(df)
-        df.dropna(how='all', axis=1, inplace=True)
-        
-        cols1 = list(df)
-        cols2 = []
-        for c in cols1:
-            s = c.split("', ")[-1]
-            s = s[1:-2]
-            cols2.append(s)
-            
-        sub_categories = []
-        for c in sub_cat:
-            if c in cols2:
-                sub_categories.append(c)
-    else:
-        sub_categories = sub_cat
     
-    try:
-        sub_categories.remove('Fiscal Year')
-    except:
-        pass
-    try:
-        sub_categories.remove('file date')
-    except:
-        pass
-    
-    return [{"label": i, "value": i} for i in sub_categories]
-
+    return sub_category_options(value, df)
 
 
 @app.callback( # Select sub-category
@@ -1453,48 +1518,7 @@ def update_output10(available_options):
     )
 def update_output11(value, df):
     
-    df2 = main_df.iloc[:, (main_df.columns.get_level_values(0)==value)]
-    sub_cat = df2.columns.get_level_values(1).tolist()
-    
-    try:
-        sub_cat.remove('Fiscal Year')
-    except:
-        pass
-    try:
-        sub_cat.remove('file date')
-    except:
-        pass
-    
-    del df2
-    
-    if df is not None:
-        df = pd.read_json(df)
-        df.dropna(how='all', axis=1, inplace=True)
-        
-        cols1 = list(df)
-        cols2 = []
-        for c in cols1:
-            s = c.split("', ")[-1]
-            s = s[1:-2]
-            cols2.append(s)
-            
-        sub_categories = []
-        for c in sub_cat:
-            if c in cols2:
-                sub_categories.append(c)
-    else:
-        sub_categories = sub_cat
-    
-    try:
-        sub_categories.remove('Fiscal Year')
-    except:
-        pass
-    try:
-        sub_categories.remove('file date')
-    except:
-        pass
-    
-    return [{"label": i, "value": i} for i in sub_cat]
+    return sub_category_options(value)
 
 
 @app.callback( # Select sub-category
@@ -1520,49 +1544,7 @@ def update_output12(available_options):
     )
 def update_output13(value, df):
     
-    df2 = main_df.iloc[:, (main_df.columns.get_level_values(0)==value)]
-    sub_cat = df2.columns.get_level_values(1).tolist()
-    
-    try:
-        sub_cat.remove('Fiscal Year')
-    except:
-        pass
-    try:
-        sub_cat.remove('file date')
-    except:
-        pass
-    
-    del df2
-    
-    if df is not None:
-        df = pd.read_json(df)
-        df.dropna(how='all', axis=1, inplace=True)
-        
-        cols1 = list(df)
-        cols2 = []
-        for c in cols1:
-            s = c.split("', ")[-1]
-            s = s[1:-2]
-            cols2.append(s)
-            
-        sub_categories = []
-        for c in sub_cat:
-            if c in cols2:
-                sub_categories.append(c)
-    else:
-        sub_categories = sub_cat
-    
-    try:
-        sub_categories.remove('Fiscal Year')
-    except:
-        pass
-    try:
-        sub_categories.remove('file date')
-    except:
-        pass
-    
-    return [{"label": i, "value": i} for i in sub_cat]
-
+    return sub_category_options(value)
 
 
 @app.callback( # Select sub-category
@@ -1587,8 +1569,10 @@ def update_output14(available_options):
      State('hospital-select1b', 'value'),
      ],
     )
+@cached_figure(dataset_arg=1, ignore_args=(0,))
 def update_data_report_plot1(n_clicks, df, var1, var2, focal_h):
     
+    df = get_dataset(df, columns=[(var1, var2)])
     if df is None or var1 is None or var1 is None:
         fig = go.Figure(data=go.Scatter(x = [0], y = [0]))
 
@@ -1611,7 +1595,6 @@ def update_data_report_plot1(n_clicks, df, var1, var2, focal_h):
         return fig
          
     
-    df = pd.read_json(df)
     if df.shape[0] == 0:
         fig = go.Figure(data=go.Scatter(x = [0], y = [0]))
 
@@ -1639,8 +1622,24 @@ def update_data_report_plot1(n_clicks, df, var1, var2, focal_h):
     x = "('Name and Num', 'Name and Num')"
     df = df[~df[x].isin([np.nan, float('NaN'), None])]
     
-    str_ = "('" + var1 + "', '" + var2 + "')"
-    df[str_] = pd.to_numeric(df[str_], errors='coerce')
+    column = feature_column(var1, var2)
+    if column not in df.columns:
+        fig = go.Figure(data=go.Scatter(x = [0], y = [0]))
+
+        fig.update_yaxes(title_font=dict(size=14, color="rgb(38, 38, 38)"))
+        fig.update_xaxes(title_font=dict(size=14, color="rgb(38, 38, 38)"))
+
+        fig.update_layout(title_font=dict(size=14, 
+                          color="rgb(38, 38, 38)"),
+                          showlegend=True,
+                          height=452,
+                          margin=dict(l=100, r=10, b=10, t=10),
+                          paper_bgcolor="#f0f0f0",
+                          plot_bgcolor="#f0f0f0")
+        
+        return fig
+    
+    df = df.assign(**{column: numeric_values(df[column])})
     
     hospitals = sorted(df[x].unique())
     
@@ -1650,36 +1649,16 @@ def update_data_report_plot1(n_clicks, df, var1, var2, focal_h):
     except:
         pass
     
+    hospital_dfs = split_by_hospital(df, hospitals)
     for i, hospital in enumerate(hospitals):
             
-        sub_df = df[df[x] == hospital]
-        sub_df.sort_values(by=["('file date', 'file date')"], ascending=True, inplace=True)
+        sub_df = hospital_dfs[i]
         dates = sub_df["('file date', 'file date')"]
         
-        str_ = "('" + var1 + "', '" + var2 + "')"
-        column = [col for col in sub_df.columns if col.endswith(str_)]  
-        
-        if len(column) == 0:
-            fig = go.Figure(data=go.Scatter(x = [0], y = [0]))
-
-            fig.update_yaxes(title_font=dict(size=14, color="rgb(38, 38, 38)"))
-            fig.update_xaxes(title_font=dict(size=14, color="rgb(38, 38, 38)"))
-
-            fig.update_layout(title_font=dict(size=14, 
-                              color="rgb(38, 38, 38)"),
-                              showlegend=True,
-                              height=452,
-                              margin=dict(l=100, r=10, b=10, t=10),
-                              paper_bgcolor="#f0f0f0",
-                              plot_bgcolor="#f0f0f0")
-            
-            return fig
-        
-        column = column[0]
         obs_y = sub_df[column].tolist()     
         hospital = str(hospital)
         
-        hi = HOSPITALS.index(hospital)
+        hi = hospital_index(hospital)
         if hospital == focal_h or focal_h == 'No focal hospital' or focal_h not in hospitals:
             clr = COLORS[hi]
         else:
@@ -1700,11 +1679,10 @@ def update_data_report_plot1(n_clicks, df, var1, var2, focal_h):
         
         
         
-    str_ = "('" + var1 + "', '" + var2 + "')"
     tdf = pd.DataFrame(columns=['mean', 'median', 'std'])
-    tdf['mean'] = df.groupby("('file date', 'file date')")[str_].mean()
-    tdf['median'] = df.groupby("('file date', 'file date')")[str_].median()
-    tdf['std'] = df.groupby("('file date', 'file date')")[str_].std()
+    tdf['mean'] = df.groupby("('file date', 'file date')")[column].mean()
+    tdf['median'] = df.groupby("('file date', 'file date')")[column].median()
+    tdf['std'] = df.groupby("('file date', 'file date')")[column].std()
     tdf['file_date'] = tdf.index
     
     fig_data.append(
@@ -1815,7 +1793,7 @@ def update_data_report_plot1(n_clicks, df, var1, var2, focal_h):
     return figure
 
 
-@app.callback( # Update Line plot
+@app.long_callback( # Update scatter plot and regression
     Output("data_report_plot2", "figure"),
     [Input("run-btn2", "n_clicks")],
     [State('categories-select2', 'value'),
@@ -1828,9 +1806,14 @@ def update_data_report_plot1(n_clicks, df, var1, var2, focal_h):
      State('hospital-select1c', 'value'),
      State("df_tab1", "data"),
      State('year-1', 'value')],
+    running=[(Output("run-btn2", "disabled"), True, False)],
+    # Loading other hospitals stops the plot
+    cancel=[Input('url_ls', 'children')],
     )
+@cached_figure(dataset_arg=9, ignore_args=(0,))
 def update_data_report_plot2(n_clicks, xvar1, xvar2, yvar1, yvar2, xscale, yscale, model, focal_h, df, yr1):
     
+    df = get_dataset(df, columns=[(xvar1, xvar2), (yvar1, yvar2)])
     if df is None or xvar1 is None or xvar2 is None or yvar1 is None or yvar2 is None or yvar2 == 'NUMBER OF BEDS':
             
         fig = go.Figure(data=go.Scatter(x = [0], y = [0]))
@@ -1853,7 +1836,6 @@ def update_data_report_plot2(n_clicks, xvar1, xvar2, yvar1, yvar2, xscale, yscal
         return fig
             
     
-    df = pd.read_json(df)
     
     if yr1 == 'All report years':
         pass
@@ -1864,19 +1846,11 @@ def update_data_report_plot2(n_clicks, xvar1, xvar2, yvar1, yvar2, xscale, yscal
     
     x = "('Name and Num', 'Name and Num')"
     df = df[~df[x].isin([np.nan, float('NaN'), None])]
-    df = df.replace({None: np.nan})
-    df = df.replace({'Not Available': np.nan})
-    
-    str_1 = xvar1 + "', '" + xvar2 + "')"
-    str_2 = yvar1 + "', '" + yvar2 + "')"
     
-    df[str_1] = pd.to_numeric(df["('" + str_1], errors='coerce')
-    df[str_2] = pd.to_numeric(df["('" + str_2], errors='coerce')
+    column1 = feature_column(xvar1, xvar2)
+    column2 = feature_column(yvar1, yvar2)
     
-    column1 = [col for col in df.columns if col.endswith(str_1)]
-    column2 = [col for col in df.columns if col.endswith(str_2)]
-    
-    if len(column1) == 0 or len(column2) == 0:
+    if column1 not in df.columns or column2 not in df.columns:
         
         fig = go.Figure(data=go.Scatter(x = [0], y = [0]))
         
@@ -1894,6 +1868,7 @@ def update_data_report_plot2(n_clicks, xvar1, xvar2, yvar1, yvar2, xscale, yscal
                       )
         return fig
     
+    df = df.assign(**{column1: numeric_values(df[column1]), column2: numeric_values(df[column2])})
     
     hospitals = sorted(df["('Name and Num', 'Name and Num')"].unique())
     
@@ -1903,136 +1878,33 @@ def update_data_report_plot2(n_clicks, xvar1, xvar2, yvar1, yvar2, xscale, yscal
     except:
         pass
     
+    # Points are transformed to the chosen scales once, for all hospitals
+    x, y, dates, names = scale_axes(df[column1], df[column2], xscale, yscale,
+                                    df["('file date', 'file date')"], df["('Name and Num', 'Name and Num')"])
+    sdf = pd.DataFrame({'x': x, 'y': y, DATE_COL: dates, NAME_COL: names})
+    
+    # Large plots are drawn with WebGL, with all hospitals except the focal
+    # hospital in one trace, and only a sample of their points is sent
+    large = PLOT_GL_POINTS > 0 and len(sdf) > PLOT_GL_POINTS
+    Scatter = go.Scattergl if large else go.Scatter
+    
     fig_data = []
+    if large:
+        fig_data = hospital_scatter_traces(sdf, focal_h if focal_h in hospitals else None)
+        hospitals = []
+    else:
+        hospital_dfs = split_by_hospital(sdf, hospitals, by=['x', 'y', DATE_COL])
+    
     for i, hospital in enumerate(hospitals):
         
-        tdf = df[df["('Name and Num', 'Name and Num')"] == hospital]
-                
-        column1 = [col for col in tdf.columns if col.endswith(str_1)]
-        column2 = [col for col in tdf.columns if col.endswith(str_2)]
-        
-        column1 = column1[0]
-        x = tdf[column1].tolist()
-        
-        column2 = column2[0]
-        y = tdf[column2].tolist()
-        
-        dates = tdf["('file date', 'file date')"]
-        
-        names = tdf["('Name and Num', 'Name and Num')"]
-        
-        text = names + '<br>' + dates.astype(str)
-        
-        x, y, dates, names = map(list, zip(*sorted(zip(x, y, dates, names), reverse=False)))
-        
-        # 1. linear-linear
-        
-        # 2. 
-        if xscale == 'log10' and yscale == 'log10':
-            x2, y2, dates2 = [], [], []
-            for i, val in enumerate(x):
-                if x[i] > 0 and y[i] > 0:
-                    x2.append(x[i])
-                    y2.append(y[i])
-                    dates2.append(dates[i])
-                    
-            x = np.log10(x2).tolist()
-            y = np.log10(y2).tolist()
-            dates = list(dates2)
-        
-        # 3.
-        elif xscale == 'square root' and yscale == 'square root':
-            x2, y2, dates2 = [], [], []
-            for i, val in enumerate(x):
-                if x[i] >= 0 and y[i] >= 0:
-                    x2.append(x[i])
-                    y2.append(y[i])
-                    dates2.append(dates[i])
-                    
-            x = np.sqrt(x2).tolist()
-            y = np.sqrt(y2).tolist()
-            dates = list(dates2)
-
-        # 4.
-        elif xscale == 'log10' and yscale == 'linear':
-            x2, y2, dates2 = [], [], []
-            for i, val in enumerate(x):
-                if x[i] > 0:
-                    x2.append(x[i])
-                    y2.append(y[i])
-                    dates2.append(dates[i])
-                    
-            x = np.log10(x2).tolist()
-            y = list(y2)
-            dates = list(dates2)
+        tdf = hospital_dfs[i]
         
-        # 5.
-        elif yscale == 'log10' and xscale == 'linear':
-            x2, y2, dates2 = [], [], []
-            for i, val in enumerate(x):
-                if y[i] > 0:
-                    x2.append(x[i])
-                    y2.append(y[i])
-                    dates2.append(dates[i])
-                    
-            x = list(x2)
-            y = np.log10(y2)
-            dates = list(dates2)
+        x = tdf['x'].tolist()
+        y = tdf['y'].tolist()
         
-        # 6.
-        elif xscale == 'square root' and yscale == 'linear':
-            x2, y2, dates2 = [], [], []
-            for i, val in enumerate(x):
-                if x[i] >= 0:
-                    x2.append(x[i])
-                    y2.append(y[i])
-                    dates2.append(dates[i])
-                    
-            x = np.sqrt(x2).tolist()
-            y = list(y2)
-            dates = list(dates2)
+        text = tdf[NAME_COL] + '<br>' + tdf[DATE_COL].astype(str)
         
-        # 7.
-        elif yscale == 'square root' and xscale == 'linear':
-            x2, y2, dates2 = [], [], []
-            for i, val in enumerate(x):
-                if y[i] >= 0:
-                    x2.append(x[i])
-                    y2.append(y[i])
-                    dates2.append(dates[i])
-                    
-            x = list(x2)
-            y = np.sqrt(y2).tolist()
-            dates = list(dates2)
-            
-        # 8. 
-        elif xscale == 'log10' and yscale == 'square root':
-            x2, y2, dates2 = [], [], []
-            for i, val in enumerate(x):
-                if x[i] > 0 and y[i] >= 0:
-                    x2.append(x[i])
-                    y2.append(y[i])
-                    dates2.append(dates[i])
-                    
-            x = np.log10(x2).tolist()
-            y = np.sqrt(y2).tolist()
-            dates = list(dates2)
-          
-        # 9.
-        elif yscale == 'log10' and xscale == 'square root':
-            x2, y2, dates2 = [], [], []
-            for i, val in enumerate(x):
-                if x[i] >= 0 and y[i] > 0:
-                    x2.append(x[i])
-                    y2.append(y[i])
-                    dates2.append(dates[i])
-                    
-            x = np.sqrt(x2).tolist()
-            y = np.log10(y2).tolist()
-            dates = list(dates2)
-            
-            
-        hi = HOSPITALS.index(hospital)
+        hi = hospital_index(hospital)
         if hospital == focal_h or focal_h == 'No focal hospital' or focal_h not in hospitals:
             clr = COLORS[hi]
         else:
@@ -2052,122 +1924,9 @@ def update_data_report_plot2(n_clicks, xvar1, xvar2, yvar1, yvar2, xscale, yscal
                     )
                 )
     
-    column1 = [col for col in df.columns if col.endswith(str_1)]
-    column2 = [col for col in df.columns if col.endswith(str_2)]
-    
-    dates = df["('file date', 'file date')"].tolist()
-    
-    column1 = column1[0]
-    x = df[column1].tolist()
-    
-    column2 = column2[0]
-    y = df[column2].tolist()
-    
-    # 1. linear-linear
-    
-    # 2. 
-    if xscale == 'log10' and yscale == 'log10':
-        x2, y2, dates2 = [], [], []
-        for i, val in enumerate(x):
-            if x[i] > 0 and y[i] > 0:
-                x2.append(x[i])
-                y2.append(y[i])
-                dates2.append(dates[i])
-                
-        x = np.log10(x2).tolist()
-        y = np.log10(y2).tolist()
-        dates = list(dates2)
-    
-    # 3.
-    elif xscale == 'square root' and yscale == 'square root':
-        x2, y2, dates2 = [], [], []
-        for i, val in enumerate(x):
-            if x[i] >= 0 and y[i] >= 0:
-                x2.append(x[i])
-                y2.append(y[i])
-                dates2.append(dates[i])
-                
-        x = np.sqrt(x2).tolist()
-        y = np.sqrt(y2).tolist()
-        dates = list(dates2)
-
-    # 4.
-    elif xscale == 'log10' and yscale == 'linear':
-        x2, y2, dates2 = [], [], []
-        for i, val in enumerate(x):
-            if x[i] > 0:
-                x2.append(x[i])
-                y2.append(y[i])
-                dates2.append(dates[i])
-                
-        x = np.log10(x2).tolist()
-        y = list(y2)
-        dates = list(dates2)
-    
-    # 5.
-    elif yscale == 'log10' and xscale == 'linear':
-        x2, y2, dates2 = [], [], []
-        for i, val in enumerate(x):
-            if y[i] > 0:
-                x2.append(x[i])
-                y2.append(y[i])
-                dates2.append(dates[i])
-                
-        x = list(x2)
-        y = np.log10(y2)
-        dates = list(dates2)
-    
-    # 6.
-    elif xscale == 'square root' and yscale == 'linear':
-        x2, y2, dates2 = [], [], []
-        for i, val in enumerate(x):
-            if x[i] >= 0:
-                x2.append(x[i])
-                y2.append(y[i])
-                dates2.append(dates[i])
-                
-        x = np.sqrt(x2).tolist()
-        y = list(y2)
-        dates = list(dates2)
-    
-    # 7.
-    elif yscale == 'square root' and xscale == 'linear':
-        x2, y2, dates2 = [], [], []
-        for i, val in enumerate(x):
-            if y[i] >= 0:
-                x2.append(x[i])
-                y2.append(y[i])
-                dates2.append(dates[i])
-                
-        x = list(x2)
-        y = np.sqrt(y2).tolist()
-        dates = list(dates2)
-        
-    # 8. 
-    elif xscale == 'log10' and yscale == 'square root':
-        x2, y2, dates2 = [], [], []
-        for i, val in enumerate(x):
-            if x[i] > 0 and y[i] >= 0:
-                x2.append(x[i])
-                y2.append(y[i])
-                dates2.append(dates[i])
-                
-        x = np.log10(x2).tolist()
-        y = np.sqrt(y2).tolist()
-        dates = list(dates2)
-      
-    # 9.
-    elif yscale == 'log10' and xscale == 'square root':
-        x2, y2, dates2 = [], [], []
-        for i, val in enumerate(x):
-            if x[i] >= 0 and y[i] > 0:
-                x2.append(x[i])
-                y2.append(y[i])
-                dates2.append(dates[i])
-                
-        x = np.sqrt(x2).tolist()
-        y = np.log10(y2).tolist()
-        dates = list(dates2)
+    x = sdf['x'].tolist()
+    y = sdf['y'].tolist()
+    dates = sdf[DATE_COL].tolist()
         
         
     tdf = pd.DataFrame(columns = ['x', 'y'])
@@ -2192,8 +1951,8 @@ def update_data_report_plot2(n_clicks, xvar1, xvar2, yvar1, yvar2, xscale, yscal
     tdf.replace([np.inf, -np.inf], np.nan, inplace=True)
     tdf.dropna(how='any', inplace=True)
         
-    x_o = tdf['x'].values.tolist()
-    y_o = tdf['y'].values.tolist()
+    x_o = tdf['x'].to_numpy(dtype=float)
+    y_o = tdf['y'].to_numpy(dtype=float)
     
     if x_o is None or y_o is None or len(x_o) == 0 or len(y_o) == 0:
         
@@ -2216,18 +1975,10 @@ def update_data_report_plot2(n_clicks, xvar1, xvar2, yvar1, yvar2, xscale, yscal
         
         return fig
         
-    x_o, y_o = zip(*sorted(zip(x_o, y_o)))
-    
-    x_o = np.array(x_o)
-    y_o = np.array(y_o)
-    
-    #Create single dimension
-    x = x_o[:, np.newaxis]
-    y = y_o[:, np.newaxis]
-
-    inds = x.ravel().argsort()  # Sort x values and get index
-    x = x.ravel()[inds].reshape(-1, 1)
-    y = y[inds] #Sort y according to x sorted index
+    # Points sorted by x (then y), so the fitted line and bands are drawn in order
+    inds = np.lexsort((y_o, x_o))
+    x_o = x_o[inds]
+    y_o = y_o[inds]
     
     d = int()
     if model == 'linear': d = 1
@@ -2235,12 +1986,8 @@ def update_data_report_plot2(n_clicks, xvar1, xvar2, yvar1, yvar2, xscale, yscal
     elif model == 'cubic': d = 3
     else: d = 1
     
-    polynomial_features = PolynomialFeatures(degree = d)
-    xp = polynomial_features.fit_transform(x)
-        
-    model = sm.OLS(y, xp).fit()
-    ypred = model.predict(xp)
-    ypred = ypred.tolist()
+    model = fit_polynomial(x_o, y_o, degree = d, alpha = 0.05)
+    ypred = model.fitted.tolist()
     
     poly_coefs = model.params[1:].tolist()
     poly_coefs.reverse()
@@ -2294,25 +2041,31 @@ def update_data_report_plot2(n_clicks, xvar1, xvar2, yvar1, yvar2, xscale, yscal
     #print('SD:', np.nanstd(np.array(y_o)/np.array(x_o)))
     #print('SE:', stats.sem(np.array(y_o)/np.array(x_o)), '\n')
     
-    st, data, ss2 = summary_table(model, alpha=0.05)
-    predict_mean_ci_low, predict_mean_ci_upp = data[:, 4:6].T
-    predict_ci_low, predict_ci_upp = data[:, 6:8].T
-    
-    outlier_y = []
-    outlier_x = []
-    nonoutlier_y = []
-    nonoutlier_x = []
-    for i, yi in enumerate(y_o):
-        if yi > predict_ci_upp[i] or yi < predict_ci_low[i]:
-            outlier_y.append(yi)
-            outlier_x.append(x_o[i])
-        else:
-            nonoutlier_y.append(yi)
-            nonoutlier_x.append(x_o[i])
+    predict_mean_ci_low, predict_mean_ci_upp = model.mean_ci_low, model.mean_ci_upp
+    predict_ci_low, predict_ci_upp = model.obs_ci_low, model.obs_ci_upp
+    
+    outliers = model.outliers(y_o)
+    outlier_y = y_o[outliers].tolist()
+    outlier_x = x_o[outliers].tolist()
+    
+    # The fit uses all points; a large plot draws all outliers, a sample of the
+    # other points and the lines at evenly spaced points
+    nonoutliers = ~outliers
+    lines = slice(None)
+    if large:
+        nonoutliers = downsample(x_o, y_o, PLOT_MAX_POINTS, keep=outliers) & ~outliers
+        lines = thin(len(x_o))
+    nonoutlier_y = y_o[nonoutliers].tolist()
+    nonoutlier_x = x_o[nonoutliers].tolist()
+    
+    x_l = x_o[lines]
+    ypred = model.fitted[lines].tolist()
+    predict_mean_ci_low, predict_mean_ci_upp = predict_mean_ci_low[lines], predict_mean_ci_upp[lines]
+    predict_ci_low, predict_ci_upp = predict_ci_low[lines], predict_ci_upp[lines]
             
     clr = "#3399ff"
     
-    fig_data.append(go.Scatter(
+    fig_data.append(Scatter(
                         x = nonoutlier_x,
                         y = nonoutlier_y,
                         name = 'Non-outliers',
@@ -2325,7 +2078,7 @@ def update_data_report_plot2(n_clicks, xvar1, xvar2, yvar1, yvar2, xscale, yscal
                     )
                 )
                 
-    fig_data.append(go.Scatter(
+    fig_data.append(Scatter(
             x = outlier_x,
             y = outlier_y,
             name = 'Outliers',
@@ -2340,7 +2093,7 @@ def update_data_report_plot2(n_clicks, xvar1, xvar2, yvar1, yvar2, xscale, yscal
     
     fig_data.append(
                 go.Scatter(
-                    x = x_o,
+                    x = x_l,
                     y = ypred,
                     mode = "lines",
                     name = 'fitted: r2 = <sup>'+str(round(r2, 3))+'</sup>',
@@ -2351,7 +2104,7 @@ def update_data_report_plot2(n_clicks, xvar1, xvar2, yvar1, yvar2, xscale, yscal
     
     fig_data.append(
         go.Scatter(
-            x = x_o,
+            x = x_l,
             y = predict_mean_ci_upp,
             mode = "lines",
             name = 'upper 95 CI',
@@ -2362,7 +2115,7 @@ def update_data_report_plot2(n_clicks, xvar1, xvar2, yvar1, yvar2, xscale, yscal
     
     fig_data.append(
         go.Scatter(
-            x = x_o,
+            x = x_l,
             y = predict_mean_ci_low,
             mode = "lines",
             name = 'lower 95 CI',
@@ -2373,7 +2126,7 @@ def update_data_report_plot2(n_clicks, xvar1, xvar2, yvar1, yvar2, xscale, yscal
     
     fig_data.append(
         go.Scatter(
-            x = x_o,
+            x = x_l,
             y = predict_ci_upp,
             mode = "lines",
             name = 'upper 95 PI',
@@ -2384,7 +2137,7 @@ def update_data_report_plot2(n_clicks, xvar1, xvar2, yvar1, yvar2, xscale, yscal
     
     fig_data.append(
         go.Scatter(
-            x = x_o,
+            x = x_l,
             y = predict_ci_low,
             mode = "lines",
             name = 'lower 95 PI',
@@ -2504,8 +2257,10 @@ def update_data_report_plot2(n_clicks, xvar1, xvar2, yvar1, yvar2, xscale, yscal
      State('hospital-select1d', 'value'),
      ],
 )
+@cached_figure(dataset_arg=1, ignore_args=(0,))
 def update_data_report_plot3(n_clicks, df, numer1, numer2, denom1, denom2, focal_h):
     
+    df = get_dataset(df, columns=[(numer1, numer2), (denom1, denom2)])
     if df is None or numer1 is None or numer2 is None or denom1 is None or denom2 is None or denom2 == 'NUMBER OF BEDS':
             
         fig = go.Figure(data=go.Scatter(x = [0], y = [0]))
@@ -2527,17 +2282,13 @@ def update_data_report_plot3(n_clicks, df, numer1, numer2, denom1, denom2, focal
         return fig
             
     
-    df = pd.read_json(df)
     
     fig_data = []
     
-    numer = numer1 + "', '" + numer2 + "')"
-    denom = denom1 + "', '" + denom2 + "')"
+    column1 = feature_column(numer1, numer2)
+    column2 = feature_column(denom1, denom2)
     
-    column1 = [col for col in df.columns if col.endswith(numer)]
-    column2 = [col for col in df.columns if col.endswith(denom)]
-    
-    if len(column1) == 0 or len(column2) == 0:
+    if column1 not in df.columns or column2 not in df.columns:
         
         fig = go.Figure(data=go.Scatter(x = [0], y = [0]))
         
@@ -2560,6 +2311,7 @@ def update_data_report_plot3(n_clicks, df, numer1, numer2, denom1, denom2, focal
     
     x = "('Name and Num', 'Name and Num')"
     df = df[~df[x].isin([np.nan, float('NaN'), None])]
+    df = df.assign(**{column1: numeric_values(df[column1]), column2: numeric_values(df[column2])})
     
     hospitals = sorted(df["('Name and Num', 'Name and Num')"].unique())
     
@@ -2569,23 +2321,19 @@ def update_data_report_plot3(n_clicks, df, numer1, numer2, denom1, denom2, focal
     except:
         pass
     
+    name_var = "('Name and Num', 'Name and Num')"
+    date_var = "('file date', 'file date')"
+    
+    df = df.assign(y = df[column1]/df[column2])
+    df = df.filter(items=['y', date_var, name_var], axis=1)
+    df = df.dropna(how='any')
+    
+    hospital_dfs = split_by_hospital(df, hospitals)
+    
     fig_data = []
-    for hospital in hospitals:
-        
-        name_var = "('Name and Num', 'Name and Num')"
-        tdf = df[df[name_var] == hospital]
-        
-        date_var = "('file date', 'file date')"
-        tdf.sort_values(by=date_var, inplace=True, ascending=True)
-        
-        column1 = [col for col in tdf.columns if col.endswith(numer)]
-        column2 = [col for col in tdf.columns if col.endswith(denom)]
+    for i, hospital in enumerate(hospitals):
         
-        column1 = column1[0]
-        column2 = column2[0]
-        tdf['y'] = tdf[column1]/tdf[column2]
-        tdf = tdf.filter(items=['y', date_var, name_var], axis=1)
-        tdf.dropna(how='any', inplace=True)
+        tdf = hospital_dfs[i]
         
         dates = tdf["('file date', 'file date')"]
         names = tdf["('Name and Num', 'Name and Num')"]
@@ -2593,7 +2341,7 @@ def update_data_report_plot3(n_clicks, df, numer1, numer2, denom1, denom2, focal
         
         text = names + '<br>' + dates.astype(str)
         
-        hi = HOSPITALS.index(hospital)
+        hi = hospital_index(hospital)
         if hospital == focal_h or focal_h == 'No focal hospital' or focal_h not in hospitals:
             clr = COLORS[hi]
         else:
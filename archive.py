@@ -0,0 +1,901 @@
+"""
+Functions for getting per-hospital data files from the Rush hospitals-data-archive
+(https://github.com/Rush-Quality-Analytics/hospitals-data-archive).
+
+Each hospital has one csv file (hospital_files/<CMS number>.csv) with a two-row
+(category, sub-category) header. The app reads these files when users click
+"Load or update data".
+
+Files are parsed with the column types declared in the bundled schema manifest
+(see column_kinds): 'Not Available' is read as missing, numeric columns are
+read as numbers and file dates as dates, so the DataFrames returned here need
+no further conversion.
+"""
+
+import io
+import os
+import ast
+import csv
+import json
+import time
+import zlib
+import pickle
+import logging
+import sqlite3
+import tempfile
+import threading
+import urllib.request
+import urllib.error
+import functools
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv as pa_csv
+
+from disk_lru import DiskLRU, write_atomic
+
+
+logger = logging.getLogger(__name__)
+
+
+ARCHIVE_URL = 'https://raw.githubusercontent.com/Rush-Quality-Analytics/hospitals-data-archive/main/hospital_files/'
+
+# Maximum number of hospital files downloaded and parsed at the same time
+FETCH_WORKERS = int(os.environ.get('HC_FETCH_WORKERS', 8))
+
+# Local disk cache of parsed hospital files. The directory can be shared by all
+# gunicorn workers. Setting HC_CACHE_BYTES to 0 turns the cache off.
+CACHE_DIR = os.environ.get('HC_CACHE_DIR',
+        os.path.join(tempfile.gettempdir(), 'hospital_compare_cache'))
+CACHE_BYTES = int(float(os.environ.get('HC_CACHE_BYTES', 500e6)))
+CACHE_TTL = float(os.environ.get('HC_CACHE_TTL', 24 * 3600))
+
+
+# Rows per record batch in the national archive file
+NATIONAL_BATCH_ROWS = 2 ** 16
+
+# Bundled (category, sub-category) column schema of the hospital files
+SCHEMA_PATH = 'dataframe_data/column_schema.json'
+SCHEMA_VERSION = 2
+
+# Parser used for hospital csv files: 'c' (pandas) or 'pyarrow' (pyarrow.csv)
+CSV_ENGINE = os.environ.get('HC_CSV_ENGINE', 'c')
+
+# Increase when parse_hospital_file returns different DataFrames, so parsed
+# files and partitions cached by an earlier version are not used.
+PARSER_VERSION = 4
+
+# Values read as missing: pandas' defaults and the archive's 'Not Available'
+NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan',
+             '1.#IND', '1.#QNAN', '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'n/a', 'nan',
+             'null', 'Not Available']
+
+# Kinds of columns in the schema. 'auto' columns are numbers if every value
+# in a file is a number (as pandas infers them) and text otherwise.
+COLUMN_KINDS = ['number', 'text', 'date', 'auto']
+
+# Columns whose kind does not depend on the schema. Facility IDs are text, so
+# CMS numbers keep their leading zeros.
+FIXED_COLUMN_KINDS = {('Name and Num', 'Name and Num'): 'text',
+                      ('Facility ID', 'Facility ID'): 'text',
+                      ('file date', 'file date'): 'date',
+                      }
+
+
+def get_cms_number(url):
+    """
+    :return: The CMS number (Facility ID) in a hospital file url or path.
+    """
+
+    return url.rstrip('/').split('/')[-1].replace('.csv', '')
+
+
+def parse_hospital_file(f, kinds=None, engine=None):
+    """
+    Parse a hospital csv file (path, url or file object) with the column kinds
+    in kinds (default: column_kinds()). Values in NA_VALUES are missing, 'number'
+    columns are numbers (values that are not numbers are missing; integers if
+    every value is a whole number, otherwise floats), 'text' columns are
+    strings and 'date' columns are datetimes.
+
+    :return: A DataFrame with (category, sub-category) columns.
+    """
+
+    if kinds is None:
+        kinds = column_kinds()
+    if engine is None:
+        engine = CSV_ENGINE
+
+    if isinstance(f, str):
+        if f.startswith(('http://', 'https://')):
+            with urllib.request.urlopen(f) as response:
+                f = io.BytesIO(response.read())
+        else:
+            with open(f, 'rb') as fh:
+                f = io.BytesIO(fh.read())
+
+    if engine == 'pyarrow':
+        tdf = parse_csv_arrow(f.read(), kinds)
+    else:
+        tdf = parse_csv_pandas(f, kinds)
+
+    for c in tdf.columns:
+        if kinds.get(c) == 'date' and tdf[c].dtype == object:
+            tdf[c] = pd.to_datetime(tdf[c])
+
+    # 'number' columns are parsed as floats; those holding only whole numbers
+    # are integers, as pandas reads them when it infers their type, so they
+    # are exported as, e.g., 37 rather than 37.0
+    numbers = [c for c in tdf.columns if kinds.get(c) == 'number' and tdf[c].dtype.kind == 'f']
+    if len(numbers) > 0 and len(tdf) > 0:
+        values = tdf[numbers].to_numpy()
+        whole = (np.isfinite(values) & (np.floor(values) == values)).all(axis=0)
+        ints = [c for c, w in zip(numbers, whole) if w]
+        if len(ints) > 0:
+            tdf[ints] = tdf[ints].astype(np.int64)
+    return tdf
+
+
+def parse_csv_pandas(f, kinds):
+    """
+    :return: The DataFrame of parse_hospital_file, parsed by pandas' csv parser.
+    """
+
+    dtype = {c: float if k == 'number' else str for c, k in kinds.items() if k in ['number', 'text']}
+    try:
+        return pd.read_csv(f, header=[0,1], index_col=[0], dtype=dtype,
+                           keep_default_na=False, na_values=NA_VALUES)
+    except ValueError:
+        pass
+
+    # A 'number' column holds text: parse again and make that text missing
+    f.seek(0)
+    dtype = {c: str for c, k in kinds.items() if k == 'text'}
+    tdf = pd.read_csv(f, header=[0,1], index_col=[0], dtype=dtype,
+                      keep_default_na=False, na_values=NA_VALUES)
+    for c in tdf.columns:
+        if kinds.get(c) == 'number' and tdf[c].dtype == object:
+            tdf[c] = pd.to_numeric(tdf[c], errors='coerce')
+    return tdf
+
+
+def parse_csv_arrow(data, kinds):
+    """
+    :return: The DataFrame of parse_hospital_file, parsed by pyarrow from the
+             bytes of a hospital csv file.
+    """
+
+    # pyarrow reads one header row, so the two header rows are read here and
+    # columns are named by position
+    lines = io.StringIO(data[:data.index(b'\n', data.index(b'\n') + 1) + 1].decode('utf-8'))
+    header = csv.reader(lines)
+    columns = list(zip(next(header), next(header)))
+    names = [str(i) for i in range(len(columns))]
+
+    types = {}
+    for name, c in zip(names, columns):
+        kind = kinds.get(c)
+        if kind == 'number':
+            types[name] = pa.float64()
+        elif kind == 'text':
+            types[name] = pa.string()
+        elif kind == 'date':
+            types[name] = pa.timestamp('ns')
+
+    def read(types):
+        return pa_csv.read_csv(io.BytesIO(data),
+                               read_options=pa_csv.ReadOptions(skip_rows=2, column_names=names,
+                                                               use_threads=False),
+                               convert_options=pa_csv.ConvertOptions(column_types=types,
+                                                                     null_values=NA_VALUES,
+                                                                     strings_can_be_null=True))
+
+    try:
+        table = read(types)
+        coerce = []
+    except pa.ArrowInvalid:
+        # A 'number' column holds text: parse it as text and make that text missing
+        coerce = [n for n, t in types.items() if t == pa.float64()]
+        table = read({n: pa.string() if n in coerce else t for n, t in types.items()})
+
+    # Columns without any values are floats, as pandas reads them
+    arrays = [pa.nulls(len(col), pa.float64()) if pa.types.is_null(col.type) else col
+              for col in table.columns]
+    tdf = pa.Table.from_arrays(arrays, names=names).to_pandas()
+
+    for name in coerce:
+        tdf[name] = pd.to_numeric(tdf[name], errors='coerce')
+
+    tdf.index = tdf.pop(names[0]).to_numpy()
+    tdf.columns = pd.MultiIndex.from_tuples(columns[1:])
+    return tdf
+
+
+def select_columns(tdf, columns):
+    """
+    :return: tdf restricted to the (category, sub-category) columns in columns
+             that it has, or all of tdf if columns is None.
+    """
+
+    if columns is None:
+        return tdf
+    return tdf[[c for c in columns if c in tdf.columns]]
+
+
+class HospitalFileCache:
+    """
+    A disk cache of parsed hospital files, keyed by CMS number.
+
+    Each entry is a pickled DataFrame (<CMS number>.pkl), so a hit skips both the
+    download and csv parsing, plus a small json file holding the url and the
+    ETag/Last-Modified headers it was downloaded with. Entries younger than ttl
+    seconds are used as they are; older entries are revalidated with a
+    conditional request. When the pickles take up more than max_bytes, the least
+    recently used entries are deleted.
+    """
+
+    def __init__(self, cache_dir, max_bytes, ttl):
+        self.files = DiskLRU(cache_dir, max_bytes, companions=('.json',))
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.counts = {'hits': 0, 'misses': 0, 'revalidated': 0, 'evictions': 0}
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+
+    def stats(self):
+        """
+        :return: A dictionary of hit/miss counters, the number of cached
+                 hospitals and their size in bytes.
+        """
+        entries = self.files.entries()
+        stats = dict(self.counts)
+        stats['entries'] = len(entries)
+        stats['bytes'] = sum([e[2] for e in entries])
+        return stats
+
+    def paths(self, cms):
+        pkl_path = self.files.path(cms)
+        return pkl_path, pkl_path[:-4] + '.json'
+
+    def load(self, cms):
+        pkl_path, meta_path = self.paths(cms)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            with open(pkl_path, 'rb') as f:
+                tdf = pickle.load(f)
+        except (OSError, ValueError, pickle.UnpicklingError, EOFError):
+            return None, None
+
+        return meta, tdf
+
+    def touch(self, cms):
+        self.files.touch(self.paths(cms)[0])
+
+    def store(self, cms, meta, tdf=None):
+        pkl_path, meta_path = self.paths(cms)
+        if tdf is not None:
+            write_atomic(pkl_path, lambda f: pickle.dump(tdf, f, protocol=pickle.HIGHEST_PROTOCOL))
+        write_atomic(meta_path, lambda f: json.dump(meta, f), mode='w')
+
+        if tdf is not None:
+            self.count('evictions', self.files.evict())
+
+    def get(self, url):
+        """
+        :return: The parsed hospital file at url, from the cache when possible.
+        """
+        cms = get_cms_number(url)
+        meta, tdf = self.load(cms)
+
+        if meta is not None and (meta.get('url') != url or meta.get('parser') != PARSER_VERSION):
+            meta, tdf = None, None
+
+        if meta is not None and time.time() - meta['checked'] < self.ttl:
+            self.count('hits')
+            self.touch(cms)
+            return tdf
+
+        request = urllib.request.Request(url)
+        if meta is not None:
+            if meta.get('etag'):
+                request.add_header('If-None-Match', meta['etag'])
+            if meta.get('last_modified'):
+                request.add_header('If-Modified-Since', meta['last_modified'])
+
+        try:
+            with urllib.request.urlopen(request) as response:
+                body = response.read()
+                headers = response.headers
+
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and meta is not None:
+                # The archive file has not changed since it was cached
+                self.count('revalidated')
+                self.count('hits')
+                meta['checked'] = time.time()
+                try:
+                    self.store(cms, meta)
+                except OSError:
+                    pass
+                self.touch(cms)
+                return tdf
+            raise
+
+        self.count('misses')
+        tdf = parse_hospital_file(io.BytesIO(body))
+
+        meta = {'url': url,
+                'parser': PARSER_VERSION,
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified'),
+                'checked': time.time(),
+                }
+        try:
+            self.store(cms, meta, tdf)
+        except OSError as e:
+            print('Could not cache', url, ':', e)
+
+        return tdf
+
+
+if CACHE_BYTES > 0:
+    hospital_cache = HospitalFileCache(CACHE_DIR, CACHE_BYTES, CACHE_TTL)
+else:
+    hospital_cache = None
+
+
+class HTTPSource:
+    """
+    Hospital files served over http(s), e.g., the hospitals-data-archive on GitHub.
+    Downloads go through the disk cache when it is turned on.
+    """
+
+    def __init__(self, url):
+        if not url.endswith('/'):
+            url = url + '/'
+        self.url = url
+
+    def location(self, cms):
+        return self.url + cms + '.csv'
+
+    def read_bytes(self, cms):
+        with urllib.request.urlopen(self.location(cms)) as response:
+            return response.read()
+
+    def read(self, cms, columns=None):
+        if hospital_cache is not None:
+            return select_columns(hospital_cache.get(self.location(cms)), columns)
+        return select_columns(parse_hospital_file(io.BytesIO(self.read_bytes(cms))), columns)
+
+
+class DirectorySource:
+    """
+    A local copy of the archive's hospital_files/ directory
+    (e.g., from cloning the hospitals-data-archive repository).
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def location(self, cms):
+        return os.path.join(self.path, cms + '.csv')
+
+    def read_bytes(self, cms):
+        with open(self.location(cms), 'rb') as f:
+            return f.read()
+
+    def read(self, cms, columns=None):
+        return select_columns(parse_hospital_file(self.location(cms)), columns)
+
+
+class SQLiteSource:
+    """
+    Hospital files stored in a single SQLite database, one compressed csv file
+    per row, indexed by CMS number. Build one with `python build_data.py sqlite`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def location(self, cms):
+        return self.path + '#' + cms
+
+    def connect(self):
+        # A read-only connection is opened per call, so threads in the
+        # fetch pool never share a connection.
+        return sqlite3.connect('file:' + self.path + '?mode=ro', uri=True)
+
+    def read_bytes(self, cms):
+        with closing(self.connect()) as con:
+            row = con.execute('SELECT data FROM hospital_files WHERE cms = ?', (cms,)).fetchone()
+        if row is None:
+            raise KeyError(cms + ' is not in ' + self.path)
+        return zlib.decompress(row[0])
+
+    def read(self, cms, columns=None):
+        return select_columns(parse_hospital_file(io.BytesIO(self.read_bytes(cms))), columns)
+
+    @staticmethod
+    def write(path, source, cms_numbers):
+        """
+        Copy hospital files from another source into a SQLite database at path.
+
+        :return: A list of CMS numbers that could not be copied.
+        """
+        failed = []
+        with closing(sqlite3.connect(path)) as con:
+            con.execute('CREATE TABLE IF NOT EXISTS hospital_files (cms TEXT PRIMARY KEY, data BLOB)')
+            for cms in cms_numbers:
+                try:
+                    data = source.read_bytes(cms)
+                except Exception as e:
+                    print('Could not copy', cms, ':', e)
+                    failed.append(cms)
+                    continue
+                con.execute('INSERT OR REPLACE INTO hospital_files VALUES (?, ?)',
+                            (cms, zlib.compress(data)))
+            con.commit()
+        return failed
+
+
+class ArrowSource:
+    """
+    A directory holding one Arrow IPC (Feather) file per hospital (<CMS number>.arrow).
+    Files are memory-mapped and stored by column, so reading a few columns only
+    touches those columns on disk. Build one with `python build_data.py arrow`.
+    """
+
+    # Reading some columns is cheaper than reading all of them
+    columnar = True
+
+    def __init__(self, path):
+        self.path = path
+
+    def location(self, cms):
+        return os.path.join(self.path, cms + '.arrow')
+
+    def read(self, cms, columns=None):
+        with pa.memory_map(self.location(cms)) as f:
+            table = pa.ipc.open_file(f).read_all()
+
+            # Columns are stored under the string form of their (category,
+            # sub-category) pair, e.g. "('HAC', 'PSI-90')"
+            if columns is not None:
+                stored = set(table.schema.names)
+                table = table.select([str(c) for c in columns if str(c) in stored])
+            tdf = table.to_pandas()
+
+        tdf.columns = pd.MultiIndex.from_tuples([ast.literal_eval(c) for c in tdf.columns])
+        return tdf
+
+    @staticmethod
+    def write(path, source, cms_numbers):
+        """
+        Copy hospital files from another source into Arrow files in the directory path.
+        Columns without any data are not copied.
+
+        :return: A list of CMS numbers that could not be copied.
+        """
+        os.makedirs(path, exist_ok=True)
+        target = ArrowSource(path)
+
+        failed = []
+        for cms in cms_numbers:
+            try:
+                tdf = source.read(cms)
+            except Exception as e:
+                print('Could not copy', cms, ':', e)
+                failed.append(cms)
+                continue
+
+            tdf = tdf.dropna(axis=1, how='all').reset_index(drop=True)
+            tdf.columns = [str(c) for c in tdf.columns]
+            # Columns mixing numbers and text (e.g., 'Not Available') are stored as text
+            text = tdf.select_dtypes(include='object')
+            tdf[text.columns] = text.astype(str).where(text.notna())
+
+            table = pa.Table.from_pandas(tdf, preserve_index=False).replace_schema_metadata(None)
+            tmp = target.location(cms) + '.tmp'
+            with pa.OSFile(tmp, 'wb') as f:
+                with pa.ipc.new_file(f, table.schema) as writer:
+                    writer.write_table(table)
+            os.replace(tmp, target.location(cms))
+
+        return failed
+
+
+class NationalArchiveSource:
+    """
+    All hospital files merged into one Arrow IPC file, sorted by Facility ID and
+    file date, with an index of each hospital's rows stored in the file's
+    metadata. The file is memory-mapped, so loading many hospitals is a slice of
+    the mapped file rather than one csv parse per hospital. Build one with
+    `python build_data.py national`.
+    """
+
+    columnar = True
+
+    def __init__(self, path):
+        self.path = path
+        self.table = None
+        self.lock = threading.Lock()
+
+    def location(self, cms):
+        return self.path + '#' + cms
+
+    def open(self):
+        # The file is mapped on first use, once per process
+        with self.lock:
+            if self.table is None:
+                table = pa.ipc.open_file(pa.memory_map(self.path)).read_all()
+                self.index = json.loads(table.schema.metadata[b'hospital_index'])
+                self.columns = {n: ast.literal_eval(n) for n in table.schema.names}
+                self.table = table
+        return self.table
+
+    def read(self, cms, columns=None):
+        tdf, failed = self.read_many([cms], columns)
+        if tdf is None:
+            raise KeyError(cms + ' is not in ' + self.path)
+        return tdf.drop(columns=[('data url', 'data url')])
+
+    def read_many(self, cms_numbers, columns=None):
+        """
+        :return: One DataFrame holding the rows of all hospitals in cms_numbers
+                 (None if none were found), with a 'data url' column, and a list
+                 of CMS numbers that are not in the archive.
+        """
+        table = self.open()
+
+        found = [cms for cms in cms_numbers if cms in self.index]
+        failed = [cms for cms in cms_numbers if cms not in self.index]
+        if len(found) == 0:
+            return None, failed
+
+        if columns is not None:
+            names = [str(c) for c in columns]
+            table = table.select([n for n in names if n in self.columns])
+
+        # Rows are sorted by CMS number, so neighbouring hospitals are one
+        # zero-copy slice of the memory-mapped file; otherwise rows are gathered
+        # with a single take().
+        rows = np.concatenate([np.arange(self.index[cms][0], sum(self.index[cms])) for cms in found])
+        if rows[-1] - rows[0] + 1 == len(rows) and np.all(np.diff(rows) == 1):
+            table = table.slice(rows[0], len(rows))
+        else:
+            table = table.take(pa.array(rows))
+
+        # Columns without data for these hospitals are not converted
+        table = table.select([n for n, col in zip(table.schema.names, table.columns)
+                              if col.null_count < len(col)])
+        tdf = table.to_pandas()
+        tdf.columns = pd.MultiIndex.from_tuples([self.columns[n] for n in tdf.columns])
+        tdf[('data url', 'data url')] = np.repeat([self.location(cms) for cms in found],
+                                                  [self.index[cms][1] for cms in found])
+        return tdf, failed
+
+    @staticmethod
+    def write(path, source, cms_numbers):
+        """
+        Merge hospital files from an ArrowSource into one national archive file.
+        Columns holding only numbers (once 'Not Available' is removed) in every
+        hospital are stored as numbers, file dates as timestamps and all other
+        columns as text.
+
+        :return: A list of CMS numbers that could not be merged.
+        """
+        cms_numbers = sorted(cms_numbers)
+        id_col = str(('Facility ID', 'Facility ID'))
+        date_col = str(('file date', 'file date'))
+        text_cols = [str(('Name and Num', 'Name and Num')), id_col, date_col]
+
+        def read_table(cms):
+            with pa.memory_map(source.location(cms)) as f:
+                table = pa.ipc.open_file(f).read_all()
+
+            columns = []
+            for col in table.columns:
+                if pa.types.is_string(col.type):
+                    missing = pc.equal(col, 'Not Available')
+                    col = pc.if_else(missing, pa.scalar(None, pa.string()), col)
+                columns.append(col)
+            return pa.Table.from_arrays(columns, names=table.schema.names)
+
+        # 1. Find all columns and whether they hold only numbers
+        failed = []
+        numeric = {}
+        for cms in cms_numbers:
+            try:
+                table = read_table(cms)
+            except Exception as e:
+                print('Could not merge', cms, ':', e)
+                failed.append(cms)
+                continue
+            for name, col in zip(table.schema.names, table.columns):
+                if numeric.get(name, True) is False:
+                    continue
+                if name in text_cols:
+                    numeric[name] = False
+                    continue
+                numeric[name] = True
+                if pa.types.is_string(col.type):
+                    try:
+                        pc.cast(col, pa.float64())
+                    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                        numeric[name] = False
+                elif not (pa.types.is_integer(col.type) or pa.types.is_floating(col.type)
+                          or pa.types.is_null(col.type)):
+                    numeric[name] = False
+
+        numeric[id_col] = False
+        names = sorted(numeric)
+        types = {n: pa.float64() if numeric[n] else pa.string() for n in names}
+        if date_col in types:
+            types[date_col] = pa.timestamp('ns')
+        schema = pa.schema([(n, types[n]) for n in names])
+        cms_numbers = [cms for cms in cms_numbers if cms not in failed]
+
+        # 2. Write one record batch per hospital, sorted by file date, and
+        #    record where each hospital's rows are.
+        index = {}
+        offset = 0
+        tmp = path + '.tmp'
+        with pa.OSFile(tmp, 'wb') as f:
+            with pa.ipc.new_file(f, schema) as writer:
+                for cms in cms_numbers:
+                    table = read_table(cms)
+                    if date_col in table.schema.names:
+                        table = table.take(pc.sort_indices(table, sort_keys=[(date_col, 'ascending')]))
+
+                    n = table.num_rows
+                    stored = set(table.schema.names)
+                    arrays = []
+                    for field in schema:
+                        if field.name == id_col:
+                            # The CMS number, with its leading zeros
+                            arrays.append(pa.array([cms] * n, pa.string()))
+                        elif field.name not in stored:
+                            arrays.append(pa.nulls(n, field.type))
+                        else:
+                            arrays.append(pc.cast(table.column(field.name), field.type).combine_chunks())
+
+                    writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+                    index[cms] = [offset, n]
+                    offset += n
+
+        # 3. Copy the batches into the final file with the index in its metadata,
+        #    combining them into large batches so that reads of many hospitals
+        #    touch few chunks. The temporary file is memory-mapped, so this
+        #    streams from disk.
+        schema = schema.with_metadata({'hospital_index': json.dumps(index)})
+        with pa.memory_map(tmp) as mf:
+            reader = pa.ipc.open_file(mf)
+            with pa.OSFile(path, 'wb') as f:
+                with pa.ipc.new_file(f, schema) as writer:
+                    batches, rows = [], 0
+                    for i in range(reader.num_record_batches):
+                        batches.append(reader.get_batch(i))
+                        rows += batches[-1].num_rows
+                        if rows >= NATIONAL_BATCH_ROWS or i == reader.num_record_batches - 1:
+                            table = pa.Table.from_batches(batches).combine_chunks()
+                            writer.write_table(table, max_chunksize=rows)
+                            batches, rows = [], 0
+        os.remove(tmp)
+
+        return failed
+
+
+def get_data_source(spec):
+    """
+    :return: A data source for spec, which is an http(s) url, a path to a
+             SQLite database (.db, .sqlite, or sqlite:///<path>), a directory of
+             Arrow files (arrow:///<path>), a national archive file
+             (national:///<path>) or a directory of hospital files.
+    """
+
+    if spec.startswith(('http://', 'https://')):
+        return HTTPSource(spec)
+    if spec.startswith('arrow:///'):
+        return ArrowSource(spec[len('arrow:///'):])
+    if spec.startswith('national:///'):
+        return NationalArchiveSource(spec[len('national:///'):])
+    if spec.startswith('sqlite:///'):
+        return SQLiteSource(spec[len('sqlite:///'):])
+    if spec.endswith(('.db', '.sqlite')):
+        return SQLiteSource(spec)
+    return DirectorySource(spec)
+
+
+# Where the app gets hospital files from
+DATA_SOURCE_SPEC = os.environ.get('HC_DATA_SOURCE', ARCHIVE_URL)
+data_source = get_data_source(DATA_SOURCE_SPEC)
+
+
+def read_hospital_file(cms, source=None, columns=None):
+    """
+    :return: A DataFrame holding one hospital's data (only the (category,
+             sub-category) pairs in columns, if given), with a 'data url'
+             column recording where the data came from.
+    """
+
+    if source is None:
+        source = data_source
+
+    tdf = source.read(cms, columns)
+    tdf[('data url', 'data url')] = [source.location(cms)] * tdf.shape[0]
+    return tdf
+
+
+def fetch_hospital_files(cms_numbers, source=None, workers=None, columns=None, on_read=None):
+    """
+    Read and parse hospital files in parallel, optionally reading only the
+    (category, sub-category) pairs in columns. If on_read is given, it is
+    called as files are read, in the order they finish, with a list of CMS
+    numbers and the DataFrame holding their data (None if they could not be
+    read), and the DataFrames are not kept.
+
+    :return: A list of DataFrames in the same order as cms_numbers (skipping
+             failed files; a single DataFrame for the national archive; empty
+             if on_read is given) and a list of CMS numbers that could not be
+             read.
+    """
+
+    if source is None:
+        source = data_source
+
+    frames = []
+    failed = []
+    if len(cms_numbers) == 0:
+        return frames, failed
+
+    # The national archive reads all hospitals in one slice
+    if hasattr(source, 'read_many'):
+        tdf, failed = source.read_many(cms_numbers, columns)
+        if tdf is not None:
+            frames.append(tdf)
+        for cms in failed:
+            print('Could not load', cms, ': not in', source.path)
+        if on_read is not None:
+            if tdf is not None:
+                on_read([cms for cms in cms_numbers if cms not in failed], tdf)
+            if len(failed) > 0:
+                on_read(failed, None)
+        return frames, failed
+
+    if workers is None:
+        workers = FETCH_WORKERS
+    workers = max(1, min(workers, len(cms_numbers)))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(read_hospital_file, cms, source, columns): cms for cms in cms_numbers}
+
+        if on_read is not None:
+            # Each file is passed to on_read and then dropped, so only files
+            # that are still being read are held here
+            for future in as_completed(futures):
+                cms = futures.pop(future)
+                try:
+                    tdf = future.result()
+                except Exception as e:
+                    print('Could not load', cms, ':', e)
+                    failed.append(cms)
+                    tdf = None
+                on_read([cms], tdf)
+            failed = [cms for cms in cms_numbers if cms in failed]
+        else:
+            # Results are collected in submission order, not completion order,
+            # so the loaded data do not depend on network timing.
+            for future, cms in futures.items():
+                try:
+                    frames.append(future.result())
+                except Exception as e:
+                    print('Could not load', cms, ':', e)
+                    failed.append(cms)
+
+    # stats() scans the cache directory, which only HTTPSource reads through
+    if hospital_cache is not None and isinstance(source, HTTPSource) and logger.isEnabledFor(logging.DEBUG):
+        logger.debug('hospital file cache: %s', hospital_cache.stats())
+
+    return frames, failed
+
+
+def read_column_schema(path=SCHEMA_PATH):
+    """
+    :return: A list of [category, sub-category, kind] entries read from the
+             bundled schema manifest.
+    """
+
+    with open(path) as f:
+        schema = json.load(f)
+
+    if schema.get('version') != SCHEMA_VERSION:
+        raise ValueError(path + ' has schema version ' + str(schema.get('version')) +
+                         ', expected ' + str(SCHEMA_VERSION) +
+                         '. Run `python build_data.py schema` to rebuild it.')
+    for c in schema['columns']:
+        if len(c) != 3 or c[2] not in COLUMN_KINDS:
+            raise ValueError(path + ' has an invalid column entry: ' + json.dumps(c))
+
+    return schema['columns']
+
+
+def load_column_schema(path=SCHEMA_PATH):
+    """
+    :return: A two-level column MultiIndex of (category, sub-category) pairs
+             read from the bundled schema manifest.
+    """
+
+    return pd.MultiIndex.from_tuples([(c[0], c[1]) for c in read_column_schema(path)])
+
+
+@functools.lru_cache(maxsize=None)
+def column_kinds(path=SCHEMA_PATH):
+    """
+    :return: A dictionary mapping (category, sub-category) pairs to the kind
+             of their column (see COLUMN_KINDS), from the bundled schema
+             manifest and FIXED_COLUMN_KINDS. Columns that are not in it are
+             read as 'auto'.
+    """
+
+    try:
+        kinds = {(c[0], c[1]): c[2] for c in read_column_schema(path)}
+    except (OSError, ValueError) as e:
+        # e.g., while the schema is being rebuilt
+        print('Could not read column kinds:', e)
+        kinds = {}
+
+    kinds.update(FIXED_COLUMN_KINDS)
+    return kinds
+
+
+def infer_column_kinds(frames):
+    """
+    :return: A dictionary mapping the columns of frames (parsed with only
+             FIXED_COLUMN_KINDS) to 'number' if they hold numbers in every
+             frame that has data for them, 'text' if they hold text in every
+             such frame, and 'auto' otherwise.
+    """
+
+    found = {}
+    for tdf in frames:
+        for c in tdf.columns:
+            if tdf[c].isna().all():
+                found.setdefault(c, set())
+            elif pd.api.types.is_numeric_dtype(tdf[c]):
+                found.setdefault(c, set()).add('number')
+            else:
+                found.setdefault(c, set()).add('text')
+
+    kinds = {c: k.pop() if len(k) == 1 else 'auto' for c, k in found.items()}
+    kinds.update({c: k for c, k in FIXED_COLUMN_KINDS.items() if c in kinds})
+    return kinds
+
+
+def write_column_schema(columns, source, path=SCHEMA_PATH, kinds=None):
+    """
+    Write a schema manifest holding the (category, sub-category) pairs in
+    columns and the kind of each column (from kinds, FIXED_COLUMN_KINDS or
+    'auto').
+    """
+
+    kinds = dict(kinds or {})
+    kinds.update(FIXED_COLUMN_KINDS)
+    entries = [[c[0], c[1], kinds.get(tuple(c), 'auto')] for c in columns]
+
+    # One column per line, so changes to the schema are easy to read in diffs
+    header = {'version': SCHEMA_VERSION,
+              'created': time.strftime('%Y-%m-%d'),
+              'source': source,
+              }
+    lines = ['"' + k + '": ' + json.dumps(v) for k, v in header.items()]
+    lines.append('"columns": [\n' + ',\n'.join([json.dumps(e) for e in entries]) + '\n]')
+
+    with open(path, 'w') as f:
+        f.write('{\n' + ',\n'.join(lines) + '\n}\n')
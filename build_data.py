@@ -0,0 +1,208 @@
+"""
+Offline build steps for data files used by the app.
+
+Usage:
+    python build_data.py schema [--source SOURCE] [--cms CMS ...] [--offline]
+    python build_data.py sqlite --out archive.db [--source SOURCE]
+    python build_data.py arrow --out DIRECTORY [--source SOURCE]
+    python build_data.py national --out national.arrow [--source SOURCE]
+    python build_data.py directory [--out FILE]
+
+Run `python build_data.py -h` for details on each command.
+"""
+
+import io
+import os
+import csv
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from archive import (ARCHIVE_URL, FIXED_COLUMN_KINDS, SCHEMA_PATH, ArrowSource, NationalArchiveSource,
+                     SQLiteSource, get_data_source, infer_column_kinds, parse_hospital_file,
+                     write_column_schema)
+from directory import ALIASES_PATH, DIRECTORY_PATH, GENDAT_PATH, write_hospital_directory
+
+
+def get_all_cms_numbers():
+    """
+    :return: A sorted list of the CMS numbers (Facility IDs) of all hospitals in the app.
+    """
+
+    gendat_df = pd.read_pickle('dataframe_data/GenDat4App.pkl')
+    gendat_df = gendat_df[~gendat_df['Facility ID'].isin([np.nan, float('NaN'), None])]
+    return sorted(gendat_df['Facility ID'].astype(str).unique().tolist())
+
+
+def get_category_file_columns():
+    """
+    :return: A list of (category, sub-category) pairs read from
+             dataframe_data/report_categories.csv and sub_categories.csv.
+    """
+
+    with open('dataframe_data/report_categories.csv', newline='') as csvfile:
+        categories = next(csv.reader(csvfile, delimiter=','))
+    with open('dataframe_data/sub_categories.csv', newline='') as csvfile:
+        sub_categories = next(csv.reader(csvfile, delimiter=','))
+
+    # Sub-category names can contain ', ', so each entry is split after
+    # the category it starts with.
+    categories = sorted([c for c in categories if c != ''], key=len, reverse=True)
+    columns = []
+    for s in sub_categories:
+        for c in categories:
+            if s.startswith(c + ', '):
+                columns.append((c, s[len(c) + 2:]))
+                break
+        else:
+            raise ValueError('No category found for ' + s)
+
+    return columns
+
+
+def build_schema(args):
+    if args.offline:
+        # Without hospital files, only the kinds of FIXED_COLUMN_KINDS are
+        # known (file_year is 'auto', which pandas reads as integers).
+        # sub_categories.csv lists the report columns, so the id and year
+        # columns of the hospital files are put where the files have them.
+        columns = get_category_file_columns()
+        columns.insert(columns.index(('file date', 'file date')) + 1, ('Facility ID', 'Facility ID'))
+        columns.append(('file_year', 'file_year'))
+        source = 'dataframe_data/sub_categories.csv'
+        kinds = None
+    else:
+        # Columns are typed by what they hold in the sampled hospital files,
+        # which are parsed without the current schema
+        data_source = get_data_source(args.source)
+        frames = []
+        for cms in args.cms:
+            if hasattr(data_source, 'read_bytes'):
+                frames.append(parse_hospital_file(io.BytesIO(data_source.read_bytes(cms)),
+                                                  kinds=FIXED_COLUMN_KINDS))
+            else:
+                frames.append(data_source.read(cms))
+        columns = []
+        for tdf in frames:
+            columns += [c for c in tdf.columns if c not in columns]
+        source = ', '.join([data_source.location(cms) for cms in args.cms])
+        kinds = infer_column_kinds(frames)
+
+    write_column_schema(columns, source, args.out, kinds)
+    print(len(columns), 'columns written to', args.out)
+
+
+def build_sqlite(args):
+    source = get_data_source(args.source)
+    cms_numbers = args.cms or get_all_cms_numbers()
+
+    failed = SQLiteSource.write(args.out, source, cms_numbers)
+    print(len(cms_numbers) - len(failed), 'hospital files written to', args.out)
+    if len(failed) > 0:
+        print(len(failed), 'failed:', ', '.join(failed))
+
+
+def build_arrow(args):
+    source = get_data_source(args.source)
+    cms_numbers = args.cms or get_all_cms_numbers()
+
+    failed = ArrowSource.write(args.out, source, cms_numbers)
+    print(len(cms_numbers) - len(failed), 'hospital files written to', args.out)
+    if len(failed) > 0:
+        print(len(failed), 'failed:', ', '.join(failed))
+
+
+def build_national(args):
+    source = get_data_source(args.source)
+    cms_numbers = args.cms or get_all_cms_numbers()
+
+    # Hospital files are first copied to Arrow files (unless the source already
+    # is a directory of Arrow files), which are then merged.
+    tmp_dir = None
+    if not isinstance(source, ArrowSource):
+        tmp_dir = tempfile.mkdtemp()
+        failed = ArrowSource.write(tmp_dir, source, cms_numbers)
+        cms_numbers = [cms for cms in cms_numbers if cms not in failed]
+        source = ArrowSource(tmp_dir)
+
+    try:
+        failed = NationalArchiveSource.write(args.out, source, cms_numbers)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+    print(len(cms_numbers) - len(failed), 'hospitals written to', args.out,
+          '(' + str(round(os.path.getsize(args.out) / 1e6, 1)) + ' MB)')
+
+
+def build_directory(args):
+    df = write_hospital_directory(args.out, args.gendat, args.aliases)
+    print(df.shape[0], 'hospitals written to', args.out,
+          '(' + str(round(os.path.getsize(args.out) / 1e6, 1)) + ' MB)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build data files used by the hospital compare app.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('schema', help='Rebuild the column schema manifest '
+                              'that the app loads at startup.')
+    p.add_argument('--out', default=SCHEMA_PATH, help='Path of the manifest to write '
+                   '(default: ' + SCHEMA_PATH + ').')
+    p.add_argument('--source', default=ARCHIVE_URL,
+                   help='Where to read the hospital file from: an http(s) url, a local '
+                   'hospital_files/ directory or a SQLite database (default: the archive on GitHub).')
+    p.add_argument('--cms', nargs='+', default=['010001'], help='CMS numbers of the hospital '
+                   'files whose columns and types are used (default: 010001).')
+    p.add_argument('--offline', action='store_true', help='Build the manifest from '
+                   'dataframe_data/sub_categories.csv instead of hospital files, when the '
+                   'archive cannot be reached. Report columns are then typed auto.')
+    p.set_defaults(func=build_schema)
+
+    p = subparsers.add_parser('sqlite', help='Copy hospital files into a SQLite database '
+                              'that can be used as HC_DATA_SOURCE.')
+    p.add_argument('--out', required=True, help='Path of the SQLite database to write.')
+    p.add_argument('--source', default=ARCHIVE_URL,
+                   help='Where to copy hospital files from: an http(s) url or a local '
+                   'hospital_files/ directory (default: the archive on GitHub).')
+    p.add_argument('--cms', nargs='*', help='CMS numbers to copy (default: all hospitals).')
+    p.set_defaults(func=build_sqlite)
+
+    p = subparsers.add_parser('arrow', help='Copy hospital files into a directory of '
+                              'Arrow (Feather) files that can be used as HC_DATA_SOURCE.')
+    p.add_argument('--out', required=True, help='Directory to write Arrow files to.')
+    p.add_argument('--source', default=ARCHIVE_URL,
+                   help='Where to copy hospital files from: an http(s) url, a local '
+                   'hospital_files/ directory or a SQLite database (default: the archive on GitHub).')
+    p.add_argument('--cms', nargs='*', help='CMS numbers to copy (default: all hospitals).')
+    p.set_defaults(func=build_arrow)
+
+    p = subparsers.add_parser('national', help='Merge hospital files into one national '
+                              'archive file that can be used as HC_DATA_SOURCE.')
+    p.add_argument('--out', required=True, help='Path of the national archive file to write.')
+    p.add_argument('--source', default=ARCHIVE_URL,
+                   help='Where to read hospital files from: an http(s) url, a local '
+                   'hospital_files/ directory, a SQLite database or a directory of Arrow '
+                   'files (default: the archive on GitHub).')
+    p.add_argument('--cms', nargs='*', help='CMS numbers to merge (default: all hospitals).')
+    p.set_defaults(func=build_national)
+
+    p = subparsers.add_parser('directory', help='Rebuild the cleaned hospital directory '
+                              'that the app loads at startup.')
+    p.add_argument('--out', default=DIRECTORY_PATH, help='Path of the directory file to write '
+                   '(default: ' + DIRECTORY_PATH + ').')
+    p.add_argument('--gendat', default=GENDAT_PATH, help='Path of the general hospital data '
+                   '(default: ' + GENDAT_PATH + ').')
+    p.add_argument('--aliases', default=ALIASES_PATH, help='CSV file of hospital names and '
+                   'the names used for them in the app (default: ' + ALIASES_PATH + ').')
+    p.set_defaults(func=build_directory)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
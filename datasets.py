@@ -0,0 +1,688 @@
+"""
+Server-side storage of the hospital data that users load in the app.
+
+A loaded dataset is a set of partitions, one DataFrame per hospital, keyed by
+data source and CMS number. Partitions are read and cleaned once, never
+modified, and shared by all datasets: adding a hospital to a selection reads
+only that hospital, and removing one reads nothing. They are kept in memory by
+the worker that read them and are also written to disk, so other gunicorn
+workers (and background jobs) can pick them up. A partition that has expired or
+been evicted is read again from its hospital file, which is cheap because the
+hospital files themselves are cached (see archive.py).
+
+The df_tab1 store in the browser only holds a small handle,
+{'id': ..., 'cms': [...], 'columns': ..., 'rows': ...}, where columns is a
+manifest of the (category, sub-category) columns that have data for any of the
+hospitals and rows is the number of rows of the dataset.
+"""
+
+import os
+import json
+import time
+import hashlib
+import uuid
+import pickle
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from archive import CACHE_DIR, DATA_SOURCE_SPEC, PARSER_VERSION, data_source, fetch_hospital_files
+from disk_lru import DiskLRU, write_atomic
+from sparse import LongPartition
+
+
+# Memory limit (bytes) of datasets kept by each worker, and the number of seconds
+# an unused dataset is kept before it expires.
+DATASET_BYTES = int(float(os.environ.get('HC_DATASET_BYTES', 1e9)))
+DATASET_TTL = float(os.environ.get('HC_DATASET_TTL', 3600))
+DATASET_DIR = os.environ.get('HC_DATASET_DIR', os.path.join(CACHE_DIR, 'datasets'))
+
+# Size limit (bytes) of the datasets written to DATASET_DIR
+DATASET_DISK_BYTES = int(float(os.environ.get('HC_DATASET_DISK_BYTES', 2e9)))
+
+# How partitions store measures: 'lossless' stores a float column as float32
+# when rounding to at most MAX_DECIMALS decimal places gives back every value
+# (e.g., 51.152), 'float32' stores all float columns as float32 (about 7
+# significant digits) and 'float64' keeps them as they are.
+FLOAT_POLICY = os.environ.get('HC_FLOAT_POLICY', 'lossless')
+MAX_DECIMALS = 6
+
+# How partitions are stored: 'wide' (a compacted DataFrame) or 'long' (a
+# LongPartition holding only the float values that are present, see sparse.py)
+PARTITION_FORMAT = os.environ.get('HC_PARTITION_FORMAT', 'wide')
+
+# Number of hospitals whose partitions are compacted together (see
+# make_partitions)
+PARTITION_BATCH = 64
+
+# Columns are named with the string form of their (category, sub-category) pair,
+# e.g. "('Name and Num', 'Name and Num')", as the rest of the app expects.
+NAME_COL = str(('Name and Num', 'Name and Num'))
+ID_COL = str(('Facility ID', 'Facility ID'))
+URL_COL = str(('data url', 'data url'))
+DATE_COL = str(('file date', 'file date'))
+
+# (category, sub-category) columns included whenever only some columns are loaded
+BASE_COLUMNS = [('Name and Num', 'Name and Num'), ('Facility ID', 'Facility ID'),
+                ('file date', 'file date'), ('file_year', 'file_year')]
+
+
+class DatasetStore:
+    """
+    A least-recently-used store of DataFrames keyed by id (hospital partitions
+    and column subsets of datasets), with a memory limit, a time-to-live and a
+    disk copy that is shared between workers. The disk copies have their own
+    size limit, disk_bytes (None for no limit).
+    """
+
+    def __init__(self, max_bytes, ttl, spill_dir, disk_bytes=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.files = DiskLRU(spill_dir, disk_bytes, ttl=ttl)
+        self.lock = threading.Lock()
+        self.datasets = OrderedDict()  # id: [DataFrame, bytes, last used time]
+        self.expired = 0  # When expired files were last removed
+        self.disk_bytes = 0  # Size of the files found then, plus those written since
+
+    def path(self, dataset_id):
+        return self.files.path(dataset_id)
+
+    def put(self, df, dataset_id=None, nbytes=None):
+        """
+        :return: The id under which df is stored. nbytes is frame_bytes of df,
+                 if it is already known.
+        """
+        if dataset_id is None:
+            dataset_id = uuid.uuid4().hex
+
+        if nbytes is None:
+            nbytes = frame_bytes([df])
+        with self.lock:
+            self.datasets[dataset_id] = [df, nbytes, time.time()]
+            self.datasets.move_to_end(dataset_id)
+            self.evict()
+
+        try:
+            path = self.path(dataset_id)
+            write_atomic(path, lambda f: pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL))
+            self.disk_bytes += os.path.getsize(path)
+        except OSError as e:
+            print('Could not write dataset', dataset_id, ':', e)
+        self.expire_files()
+
+        return dataset_id
+
+    def get(self, dataset_id, from_disk=True):
+        """
+        :return: The DataFrame stored under dataset_id, or None if it has expired
+                 (or is not in memory and from_disk is False). The DataFrame is
+                 shared, so callers must not modify it in place.
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.datasets.get(dataset_id)
+            if entry is not None and now - entry[2] < self.ttl:
+                entry[2] = now
+                self.datasets.move_to_end(dataset_id)
+                return entry[0]
+
+        if not from_disk:
+            return None
+
+        # Built by another worker, or evicted from this worker's memory
+        path = self.path(dataset_id)
+        try:
+            if now - os.path.getmtime(path) >= self.ttl:
+                return None
+            with open(path, 'rb') as f:
+                df = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        self.files.touch(path)
+
+        nbytes = frame_bytes([df])
+        with self.lock:
+            self.datasets[dataset_id] = [df, nbytes, now]
+            self.evict()
+        return df
+
+    def evict(self):
+        # Called with self.lock held
+        now = time.time()
+        for dataset_id in [k for k, v in self.datasets.items() if now - v[2] >= self.ttl]:
+            del self.datasets[dataset_id]
+
+        total = sum([v[1] for v in self.datasets.values()])
+        while total > self.max_bytes and len(self.datasets) > 1:
+            dataset_id, entry = self.datasets.popitem(last=False)
+            total -= entry[1]
+
+    def expire_files(self):
+        # The directory is scanned at most once a minute, unless the files
+        # written since it was last scanned may have gone over its size limit
+        now = time.time()
+        full = self.files.max_bytes is not None and self.disk_bytes > self.files.max_bytes
+        if now - self.expired < 60 and not full:
+            return
+        self.expired = now
+        self.files.evict()
+        self.disk_bytes = sum([e[2] for e in self.files.entries()])
+
+
+dataset_store = DatasetStore(DATASET_BYTES, DATASET_TTL, DATASET_DIR, DATASET_DISK_BYTES)
+
+
+def prepare_hospital_frame(tdf):
+    """
+    :return: A hospital file's DataFrame with string column names and without
+             the columns it has no data for.
+    """
+
+    # Most of the ~750 columns are empty for any one hospital. Dropping them
+    # here makes concatenating many hospitals several times faster.
+    tdf = tdf.dropna(axis=1, how='all')
+    tdf.columns = [str(c) for c in tdf.columns]
+    return tdf
+
+
+def feature_column(var1, var2):
+    """
+    :return: The name of the column that holds the (category, sub-category)
+             feature (var1, var2).
+    """
+
+    return str((var1, var2))
+
+
+def numeric_values(values):
+    """
+    :return: values, a column of a dataset, as numbers. 'auto' columns (see
+             archive.COLUMN_KINDS) are text in hospitals whose files hold
+             text for them (e.g., 'Too Few to Report'), and that text is
+             missing here.
+    """
+
+    if pd.api.types.is_numeric_dtype(values):
+        return values
+    return pd.to_numeric(values, errors='coerce')
+
+
+def combine_frames(frames):
+    """
+    :return: One DataFrame holding the rows of frames, without rows that have
+             no hospital name or columns that have no data. Columns keep the
+             types they were parsed with (see archive.parse_hospital_file).
+    """
+
+    df = pd.concat(frames) if len(frames) > 1 else frames[0]
+    df = df.dropna(axis=1, how='all')
+    df = df[df[NAME_COL].notna()]
+    return df.reset_index(drop=True)
+
+
+def reduce_groups(func, a, bounds):
+    """
+    :return: func (a ufunc such as np.logical_or) reduced over each group of
+             rows of the array a, the rows from each of bounds to the next.
+             Empty groups give func's identity.
+    """
+
+    bounds = np.asarray(bounds, dtype=np.intp)
+    full = np.diff(bounds) > 0
+    out = np.full((len(bounds) - 1,) + a.shape[1:], func.identity, dtype=a.dtype)
+    if full.any():
+        out[full] = func.reduceat(a, bounds[:-1][full], axis=0)
+    return out
+
+
+def restoring_decimals(small, values, bounds):
+    """
+    :return: For each group of rows of the float64 array values (the rows from
+             each of bounds to the next) and each column, the fewest decimal
+             places (up to MAX_DECIMALS) to which the same rows and column of
+             the float32 array small can be rounded to give back values, or -1
+             if there are none.
+    """
+
+    restored = small.astype(np.float64)
+    missing = np.isnan(values)
+    found = np.full((len(bounds) - 1, values.shape[1]), -1)
+    for d in range(MAX_DECIMALS + 1):
+        scale = 10.0 ** d
+        exact = (np.rint(restored * scale) / scale == values) | missing
+        exact = reduce_groups(np.logical_and, exact, bounds)
+        found[(found < 0) & exact] = d
+    return found
+
+
+def smallest_int(values):
+    """
+    :return: The integer array values in the smallest integer type that holds
+             them, as pd.to_numeric(downcast='integer') would give.
+    """
+
+    lo, hi = (values.min(), values.max()) if len(values) > 0 else (0, 0)
+    for t in [np.int8, np.int16, np.int32]:
+        if np.iinfo(t).min <= lo and hi <= np.iinfo(t).max:
+            return values.astype(t)
+    return values
+
+
+def compact_frames(df, bounds):
+    """
+    :return: For each group of rows of df (the rows from each of bounds to the
+             next), a DataFrame of the group's rows that takes less memory
+             columns with no data in the group are dropped, text columns that
+             repeat their values (e.g., the hospital name on every row) are
+             categoricals, integer columns use the smallest integer type and
+             float columns are float32 where FLOAT_POLICY allows. Under the
+             'lossless' policy, the decimal places that restore each float32
+             column are kept in attrs['decimals']. expand_frame restores the
+             column types and values. Also returns the bytes the groups' rows
+             took before, as frame_bytes counts them.
+    """
+
+    # All groups are compacted together, on one array per column type, which
+    # is much faster than one group at a time for the ~750 columns
+    dtypes = df.dtypes.to_dict()
+    floats = [c for c, dtype in dtypes.items() if dtype == np.float64]
+    others = {c: df[c].to_numpy() for c, dtype in dtypes.items() if dtype != np.float64}
+    values = df[floats].to_numpy(dtype=np.float64)
+    has_data = reduce_groups(np.logical_or, ~np.isnan(values), bounds)
+    others_data = {c: reduce_groups(np.logical_or, pd.notna(v), bounds) for c, v in others.items()}
+
+    # The columns each group has data for, in the order of df
+    position = {c: i for i, c in enumerate(df.columns)}
+    float_position = np.array([position[c] for c in floats], dtype=np.intp)
+
+    # Text columns are factorized once, with sorted categories as
+    # pd.Categorical has them, and each group's categoricals are taken from
+    # the codes
+    texts = {}
+    for c, v in others.items():
+        if v.dtype == object:
+            try:
+                texts[c] = pd.factorize(v, sort=True)
+            except TypeError:
+                pass
+
+    small = values.astype(np.float32) if FLOAT_POLICY != 'float64' else values
+    found = np.full(has_data.shape, -1)
+    if FLOAT_POLICY == 'lossless':
+        found = restoring_decimals(small, values, bounds)
+    to_small = found >= 0 if FLOAT_POLICY != 'float32' else np.ones(has_data.shape, dtype=bool)
+    float_names = np.array(floats, dtype=object)
+
+    frames = []
+    nbytes = 0
+    for g in range(len(bounds) - 1):
+        rows = slice(bounds[g], bounds[g + 1])
+        nbytes += pd.RangeIndex(rows.stop - rows.start).memory_usage()
+        nbytes += 8 * (rows.stop - rows.start) * int(has_data[g].sum())
+        columns = {}
+        for c, v in others.items():
+            if not others_data[c][g]:
+                continue
+            v = v[rows]
+            nbytes += v.nbytes
+            if v.dtype == object:
+                nbytes += pd.Series(v).memory_usage(index=False, deep=True) - v.nbytes
+            if c in texts:
+                codes, categories = texts[c]
+                codes = codes[rows]
+                used = np.unique(codes[codes >= 0])
+                if len(used) <= len(v) // 2:
+                    codes = np.where(codes >= 0, np.searchsorted(used, codes), -1)
+                    v = pd.Categorical.from_codes(codes, categories[used])
+            elif v.dtype == object:
+                if pd.Series(v).nunique() <= len(v) // 2:
+                    v = pd.Categorical(v)
+            elif v.dtype.kind == 'i':
+                v = smallest_int(v)
+            columns[c] = v
+
+        blocks = [pd.DataFrame(columns, index=pd.RangeIndex(rows.stop - rows.start))]
+        positions = [[position[c] for c in columns]]
+        for block, keep in [(small, has_data[g] & to_small[g]), (values, has_data[g] & ~to_small[g])]:
+            if keep.any():
+                blocks.append(pd.DataFrame(block[rows][:, keep], columns=float_names[keep]))
+                positions.append(float_position[keep])
+        # The columns are put back in the order of df
+        part = pd.concat(blocks, axis=1) if len(blocks) > 1 else blocks[0]
+        part = part.take(np.argsort(np.concatenate(positions)), axis=1)
+
+        rounded = np.flatnonzero(has_data[g] & to_small[g] & (found[g] >= 0))
+        part.attrs['decimals'] = {floats[i]: int(found[g, i]) for i in rounded}
+        frames.append(part)
+    return frames, int(nbytes)
+
+
+def expand_frame(df, parts=None):
+    """
+    :return: df, which holds the rows of the partitions in parts (default: df
+             is one partition), with the column types and values the
+             partitions had before compact_frames: categoricals as text,
+             float32 as float64 (rounded to the decimals in the partitions'
+             attrs) and integers as int64.
+    """
+
+    if parts is None:
+        parts = [df]
+
+    columns = {c: df[c].to_numpy() for c in df.columns}
+    for c, values in columns.items():
+        if values.dtype == np.float32:
+            columns[c] = values.astype(np.float64)
+        elif values.dtype.kind in 'iu' and values.dtype != np.int64:
+            columns[c] = values.astype(np.int64)
+
+    # Each partition's rows are rounded to that partition's decimals, for all
+    # rounded columns at once
+    rounded = set()
+    for p in parts:
+        rounded.update(p.attrs.get('decimals', {}))
+    rounded = [c for c in df.columns if c in rounded]
+
+    # A column that holds text in some partitions is not a float column, and
+    # only the rows of partitions where it is float32 are rounded
+    for c in [c for c in rounded if columns[c].dtype.kind != 'f']:
+        values = columns[c].copy()
+        end = 0
+        for p in parts:
+            end += len(p)
+            d = p.attrs.get('decimals', {}).get(c)
+            if d is not None:
+                rows = slice(end - len(p), end)
+                values[rows] = np.rint(values[rows].astype(np.float64) * 10.0 ** d) / 10.0 ** d
+        columns[c] = values
+    rounded = [c for c in rounded if columns[c].dtype.kind == 'f']
+    if len(rounded) > 0:
+        decimals = np.array([[p.attrs.get('decimals', {}).get(c, np.nan) for c in rounded] for p in parts])
+        scale = np.repeat(10.0 ** decimals, [len(p) for p in parts], axis=0)
+        values = np.column_stack([columns[c] for c in rounded]).astype(np.float64)
+        values = np.where(np.isnan(scale), values, np.rint(values * scale) / scale)
+        for i, c in enumerate(rounded):
+            columns[c] = values[:, i]
+
+    return pd.DataFrame(columns, index=df.index)
+
+
+def make_partitions(df, keys):
+    """
+    :return: A dictionary of key: the partition stored for the rows of df (one
+             or more hospital files' DataFrame as read) whose key (e.g., CMS
+             number) in keys, one per row, is key. Rows that have no hospital
+             name are dropped and partitions are compacted (see
+             compact_frames) and, if PARTITION_FORMAT is 'long', hold their
+             float columns in a LongPartition. Also returns the bytes the
+             partitions' rows took before compacting.
+    """
+
+    # The rows of each key are gathered (keeping their order) and compacted
+    # PARTITION_BATCH keys at a time
+    named = np.flatnonzero(df[('Name and Num', 'Name and Num')].notna().to_numpy())
+    codes, uniques = pd.factorize(np.asarray(keys, dtype=object)[named])
+    order = named[np.argsort(codes, kind='stable')]
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(uniques)))])
+
+    parts = {}
+    nbytes = 0
+    for i in range(0, len(uniques), PARTITION_BATCH):
+        j = min(i + PARTITION_BATCH, len(uniques))
+        batch = df.take(order[bounds[i]:bounds[j]])
+        batch.columns = [str(c) for c in batch.columns]
+        frames, n = compact_frames(batch, bounds[i:j + 1] - bounds[i])
+        nbytes += n
+        for key, part in zip(uniques[i:j], frames):
+            parts[key] = long_partition(part) if PARTITION_FORMAT == 'long' else part
+    return parts, nbytes
+
+
+def long_partition(part):
+    """
+    :return: The LongPartition of part, a compacted partition, which holds its
+             float columns.
+    """
+
+    # One block per float type, so that float32 columns stay float32
+    dtypes = part.dtypes.to_dict()
+    types = [np.float32, np.float64]
+    blocks = [[c for c, t in dtypes.items() if t == dtype] for dtype in types]
+    floats = blocks[0] + blocks[1]
+    decimals = part.attrs['decimals']
+    arrays = [part[b].to_numpy(dtype=t) for b, t in zip(blocks, types)]
+    return LongPartition(part.drop(columns=floats), floats, arrays,
+                         decimals=[decimals.get(c, -1) for c in floats], columns=part.columns)
+
+
+def partition_column(part, name):
+    """
+    :return: The values of the column name of a partition as an array (all
+             missing if the partition has no such column).
+    """
+
+    if isinstance(part, LongPartition):
+        return part.column(name)
+    if name in part.columns:
+        return part[name].to_numpy()
+    return np.full(len(part), np.nan)
+
+
+def frame_bytes(frames):
+    """
+    :return: The memory used by the DataFrames (or LongPartitions) in frames,
+             in bytes, as memory_usage(deep=True) counts it. Only text and
+             categorical columns are measured one by one, which is much faster
+             for the hundreds of numeric columns of a partition.
+    """
+
+    total = 0
+    for df in frames:
+        if isinstance(df, LongPartition):
+            total += df.nbytes()
+            continue
+        total += df.index.memory_usage()
+        for c, dtype in df.dtypes.items():
+            if dtype == object or isinstance(dtype, pd.CategoricalDtype):
+                total += df[c].memory_usage(index=False, deep=True)
+            else:
+                total += dtype.itemsize * len(df)
+    return int(total)
+
+
+def partition_key(cms):
+    """
+    :return: The dataset_store id of a hospital's partition. Partitions
+             stored with another PARTITION_FORMAT or FLOAT_POLICY have other
+             ids.
+    """
+
+    key = json.dumps([DATA_SOURCE_SPEC, PARSER_VERSION, PARTITION_FORMAT, FLOAT_POLICY, cms])
+    return 'hospital-' + hashlib.md5(key.encode()).hexdigest()
+
+
+def load_partitions(cms_ls, progress=None, partial=None):
+    """
+    Get the partitions of the hospitals in cms_ls, reading only those that are
+    not in dataset_store. Partitions that are read are stored compacted (see
+    make_partitions) and the memory saved is printed. If progress is given, it is called with the number
+    of hospitals loaded so far and the number of hospitals in cms_ls. If
+    partial is given, it is called with the partitions loaded so far while the
+    others are still being read: after the first hospital that is read, and
+    then each time the number of hospitals read doubles.
+
+    :return: A dictionary of CMS number: partition, in the order of cms_ls, and
+             a list of CMS numbers that could not be loaded.
+    """
+
+    parts = {}
+    for cms in cms_ls:
+        tdf = dataset_store.get(partition_key(cms))
+        if tdf is not None:
+            parts[cms] = tdf
+
+    missing = [cms for cms in cms_ls if cms not in parts]
+    locations = {data_source.location(cms): cms for cms in missing}
+    total = len(cms_ls)
+    done = total - len(missing)
+    next_partial = done + 1
+
+    if progress is not None:
+        progress(done, total)
+
+    nbytes = [0, 0]  # Before and after compacting the partitions that are read
+
+    def on_read(numbers, tdf):
+        nonlocal done, next_partial
+        done += len(numbers)
+        if tdf is not None:
+            # The national archive reads many hospitals at once, which are
+            # split by their data url
+            if len(numbers) == 1:
+                keys = np.full(len(tdf), numbers[0], dtype=object)
+            else:
+                keys = tdf[('data url', 'data url')].map(locations).to_numpy()
+            made, n = make_partitions(tdf, keys)
+            nbytes[0] += n
+            for cms in numbers:
+                # A hospital without named rows gets an empty partition
+                part = made[cms] if cms in made else pd.DataFrame()
+                n = frame_bytes([part])
+                nbytes[1] += n
+                dataset_store.put(part, partition_key(cms), n)
+                parts[cms] = part
+
+        if progress is not None:
+            progress(done, total)
+        if partial is not None and done >= next_partial and done < total:
+            next_partial = 2 * done - (total - len(missing))
+            partial({cms: parts[cms] for cms in cms_ls if cms in parts})
+
+    frames, failed = fetch_hospital_files(missing, on_read=on_read)
+    if nbytes[0] > 0:
+        print('partitions:', len(missing) - len(failed), 'read,', nbytes[0], 'bytes compacted to', nbytes[1])
+
+    return {cms: parts[cms] for cms in cms_ls if cms in parts}, failed
+
+
+def concat_partitions(parts, columns=None):
+    """
+    :return: One DataFrame holding the rows of the partitions in parts (None if
+             there are none), restricted to the columns in columns if given,
+             with the column types the partitions had before compact_frames.
+    """
+
+    parts = list(parts)
+    if len(parts) == 0:
+        return None
+    if columns is None:
+        parts = [p.to_frame() if isinstance(p, LongPartition) else p for p in parts]
+        return expand_frame(pd.concat(parts, ignore_index=True), parts)
+
+    # For a few columns, joining each column's arrays is much faster than
+    # pd.concat, whose cost grows with the number of partitions
+    present = set()
+    for p in parts:
+        present.update(p.columns)
+
+    data = {}
+    for c in columns:
+        if c in present:
+            data[c] = np.concatenate([partition_column(p, c) for p in parts])
+    return expand_frame(pd.DataFrame(data), parts)
+
+
+def build_dataset(cms_ls, columns=None, progress=None):
+    """
+    Load the hospitals in cms_ls. If columns is given, only those (category,
+    sub-category) columns (plus hospital names, ids and file dates) are read;
+    otherwise, the hospitals' partitions are loaded (see load_partitions).
+
+    :return: A DataFrame holding the hospitals' data (None if nothing could be
+             loaded) and a list of CMS numbers that could not be loaded.
+    """
+
+    if columns is None:
+        parts, failed = load_partitions(cms_ls, progress=progress)
+        return concat_partitions(parts.values()), failed
+
+    columns = BASE_COLUMNS + [c for c in columns if c not in BASE_COLUMNS]
+    frames, failed = fetch_hospital_files(cms_ls, columns=columns)
+    frames = [prepare_hospital_frame(tdf) for tdf in frames]
+    if len(frames) == 0:
+        return None, failed
+
+    return combine_frames(frames), failed
+
+
+def column_manifest(parts, schema):
+    """
+    :return: A bitset (as a hex string) of the columns in schema, a list of
+             column names, that have data in any of the partitions in parts.
+    """
+
+    present = set()
+    for p in parts:
+        present.update(p.columns)
+
+    bits = np.array([c in present for c in schema], dtype=bool)
+    return np.packbits(bits).tobytes().hex()
+
+
+def manifest_columns(manifest, schema):
+    """
+    :return: A boolean array that is True for the columns in schema that are
+             set in a bitset made by column_manifest.
+    """
+
+    bits = np.unpackbits(np.frombuffer(bytes.fromhex(manifest), dtype=np.uint8))
+    return bits[:len(schema)].astype(bool)
+
+
+def dataset_fingerprint(data):
+    """
+    :return: A string that is the same for all datasets of the same hospitals
+             read from the same data source (None if data is None).
+    """
+
+    if data is None:
+        return None
+
+    key = json.dumps([DATA_SOURCE_SPEC, sorted(data['cms'])])
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+def get_dataset(data, columns=None):
+    """
+    :return: The DataFrame that a df_tab1 handle refers to, or None. If columns
+             is given, only those (category, sub-category) columns (plus hospital
+             names, ids and file dates) are returned.
+    """
+
+    if data is None:
+        return None
+
+    names = None
+    if columns is not None:
+        columns = BASE_COLUMNS + [c for c in columns if c not in BASE_COLUMNS]
+        names = [str(c) for c in columns] + [URL_COL]
+
+    if columns is not None and getattr(data_source, 'columnar', False):
+        # A columnar data source (ArrowSource) reads only the needed columns,
+        # which is cheaper than reading partitions that are not in memory
+        parts = [dataset_store.get(partition_key(cms), from_disk=False) for cms in data['cms']]
+        if any([p is None for p in parts]):
+            key = data['id'] + '-' + hashlib.md5(str(names).encode()).hexdigest()
+            df = dataset_store.get(key)
+            if df is None:
+                df, failed = build_dataset(data['cms'], columns=columns)
+                if df is None:
+                    return None
+                dataset_store.put(df, key)
+            return df
+        return concat_partitions(parts, names)
+
+    parts, failed = load_partitions(data['cms'])
+    return concat_partitions(parts.values(), names)
@@ -0,0 +1,292 @@
+"""
+The hospital directory: names, CMS numbers, states, hospital types, ownership,
+numbers of beds and locations of all hospitals in the app.
+
+The directory is built from dataframe_data/GenDat4App.pkl by an offline step
+(python build_data.py directory), which drops unnamed hospitals, fills missing
+states, types and ownership, applies the name corrections in
+dataframe_data/name_aliases.csv and stores the result as a csv file. The app
+loads it at startup, with compactly typed columns, instead of repeating the
+cleanup in every worker.
+"""
+
+import re
+import csv
+import functools
+
+import numpy as np
+import pandas as pd
+
+
+GENDAT_PATH = 'dataframe_data/GenDat4App.pkl'
+ALIASES_PATH = 'dataframe_data/name_aliases.csv'
+DIRECTORY_PATH = 'dataframe_data/hospital_directory.csv'
+
+# Increase when the columns or cleanup of the directory change, so that an
+# outdated file is not used.
+DIRECTORY_VERSION = 1
+
+# Columns with few distinct values, stored as categoricals
+CATEGORY_COLUMNS = ['Emergency Services', 'Hospital Ownership', 'Hospital Type', 'State']
+
+# Number of filter results memoized by each HospitalFilter
+FILTER_CACHE_SIZE = 256
+
+# Maximum number of hospitals returned by HospitalSearch
+SEARCH_LIMIT = 100
+
+# Columns where a missing value is shown as 'Not given' in the app's filters
+NOT_GIVEN_COLUMNS = ['State', 'Hospital Type', 'Hospital Ownership']
+
+
+def read_name_aliases(path=ALIASES_PATH):
+    """
+    :return: A dictionary of hospital names ('Name and Num') as they appear in
+             GenDat4App.pkl and the names used for them in the app.
+    """
+
+    with open(path, newline='') as csvfile:
+        return {row['name']: row['alias'] for row in csv.DictReader(csvfile)}
+
+
+def clean_hospital_directory(gendat_df, aliases):
+    """
+    :return: A copy of gendat_df without unnamed hospitals, with 'Not given' for
+             missing states, types and ownership, names replaced by their
+             aliases and compact column types.
+    """
+
+    df = gendat_df[~gendat_df['Name and Num'].isin([np.nan, float('NaN')])].copy()
+    df.reset_index(drop=True, inplace=True)
+
+    for c in NOT_GIVEN_COLUMNS:
+        df[c] = df[c].replace(np.nan, 'Not given')
+
+    df['Name and Num'] = df['Name and Num'].replace(aliases)
+    return type_hospital_directory(df)
+
+
+def type_hospital_directory(df):
+    """
+    :return: df with compact column types (in place).
+    """
+
+    for c in CATEGORY_COLUMNS:
+        df[c] = df[c].astype('category')
+
+    # Beds can be missing, so they are stored as floats. Both numbers of beds
+    # and coordinates (to about 1 m) are exact in float32.
+    for c in ['Beds', 'Lat', 'Lon']:
+        df[c] = pd.to_numeric(df[c]).astype(np.float32)
+
+    return df
+
+
+def write_hospital_directory(path=DIRECTORY_PATH, gendat_path=GENDAT_PATH, aliases_path=ALIASES_PATH):
+    """
+    :return: The cleaned directory that was written to path.
+    """
+
+    df = clean_hospital_directory(pd.read_pickle(gendat_path), read_name_aliases(aliases_path))
+
+    # A csv file, unlike a pickle, can be read by any version of pandas; its
+    # first line records the version of the build step.
+    with open(path, 'w', newline='') as f:
+        f.write('# hospital directory version ' + str(DIRECTORY_VERSION) + '\n')
+        df.to_csv(f, index=False)
+    return df
+
+
+def load_hospital_directory(path=DIRECTORY_PATH):
+    """
+    :return: The hospital directory DataFrame read from path. Raises OSError if
+             the file cannot be read and ValueError if it was written by an
+             incompatible version of the build step.
+    """
+
+    with open(path, newline='') as f:
+        line = f.readline().strip()
+        if line != '# hospital directory version ' + str(DIRECTORY_VERSION):
+            raise ValueError(path + ' starts with ' + repr(line) + ', expected hospital directory version '
+                             + str(DIRECTORY_VERSION) + '; rebuild it with python build_data.py directory')
+
+        # Only missing values are empty; names such as 'NA' are kept
+        df = pd.read_csv(f, dtype=str, keep_default_na=False, na_values=[''])
+
+    return type_hospital_directory(df)
+
+
+class HospitalFilter:
+    """
+    An index for filtering hospitals by number of beds, state, type and
+    ownership. Rows are sorted by number of beds, so a range of beds is found
+    by binary search, and states, types and ownership are stored as integer
+    codes, so a set of selected values is checked with one lookup per row.
+    Results are memoized per combination of filter values.
+    """
+
+    def __init__(self, names, beds, states, htypes, ctypes, cache_size=FILTER_CACHE_SIZE):
+        # Rows hold codes of the sorted unique names, so names of selected rows
+        # come out sorted and without duplicates.
+        self.names, name_codes = np.unique(names, return_inverse=True)
+
+        # Hospitals without a number of beds (NaN, sorted last) never match a range
+        order = np.argsort(beds, kind='stable')
+        n = np.count_nonzero(~np.isnan(beds))
+        self.sorted_beds = np.asarray(beds)[order[:n]]
+        self.name_codes = name_codes[order[:n]]
+
+        self.codes = []
+        self.categories = []
+        for values in [states, htypes, ctypes]:
+            categories, codes = np.unique(np.asarray(values)[order[:n]], return_inverse=True)
+            self.categories.append({c: i for i, c in enumerate(categories.tolist())})
+            self.codes.append(codes.astype(np.int16))
+
+        self.select_ids_cached = functools.lru_cache(maxsize=cache_size)(self.filter)
+        self.select_cached = functools.lru_cache(maxsize=cache_size)(self.filter_names)
+
+    @staticmethod
+    def key(bed_range, states, htypes, ctypes):
+        low, high = bed_range
+        return (float(low), float(high)) + tuple([frozenset(v or []) for v in [states, htypes, ctypes]])
+
+    def filter(self, key):
+        low, high = key[0], key[1]
+        start = np.searchsorted(self.sorted_beds, low, side='right')
+        stop = np.searchsorted(self.sorted_beds, high, side='left')
+        rows = np.arange(start, max(start, stop))
+
+        for values, codes, categories in zip(key[2:], self.codes, self.categories):
+            selected = np.zeros(len(categories), dtype=bool)
+            selected[[categories[v] for v in values if v in categories]] = True
+            rows = rows[selected[codes[rows]]]
+
+        return np.unique(self.name_codes[rows])
+
+    def filter_names(self, key):
+        return self.names[self.select_ids_cached(key)].tolist()
+
+    def select_ids(self, bed_range, states, htypes, ctypes):
+        """
+        :return: A sorted array of the positions (in self.names) of hospitals with
+                 more than bed_range[0] and fewer than bed_range[1] beds, in one of
+                 the given states, of one of the given types and with one of the
+                 given kinds of ownership. The array is shared by later calls and
+                 must not be modified.
+        """
+
+        return self.select_ids_cached(self.key(bed_range, states, htypes, ctypes))
+
+    def select(self, bed_range, states, htypes, ctypes):
+        """
+        :return: A sorted list of the names of the selected hospitals (see
+                 select_ids). The list is shared by later calls and must not be
+                 modified.
+        """
+
+        return self.select_cached(self.key(bed_range, states, htypes, ctypes))
+
+
+class HospitalSearch:
+    """
+    An index for searching hospitals by name or CMS number. Queries are matched
+    (without case) against the start of names, the start of each word in names
+    and CMS numbers, using binary search over sorted keys, and anywhere in names
+    using an index of the three-letter sequences (trigrams) they contain.
+    """
+
+    def __init__(self, names):
+        # names is a sorted array of unique hospital names, e.g.
+        # HospitalFilter.names. Names and keys are kept in NumPy string arrays
+        # rather than lists of Python strings (see HospitalFilter).
+        self.names = np.asarray(names, dtype=str)
+        lower = [normalize_query(n) for n in self.names.tolist()]
+        self.lower = np.array(lower, dtype=str)
+
+        # Name keys rank before word and CMS number keys
+        name_keys = []
+        word_keys = []
+        for i, n in enumerate(lower):
+            name_keys.append((n, i))
+            for m in re.finditer(r'(?<=\s)\S', n):
+                word_keys.append((n[m.start():], i))
+            cms = re.search(r'\(([^()]*)\)$', n)
+            if cms is not None:
+                word_keys.append((cms.group(1), i))
+
+        self.keys = []
+        for keys in [name_keys, word_keys]:
+            keys.sort()
+            self.keys.append((np.array([k for k, i in keys]), np.array([i for k, i in keys], dtype=np.int32)))
+
+        # The hospitals that contain each trigram are at
+        # gram_ids[gram_ptr[k]:gram_ptr[k + 1]] for the trigram gram_keys[k]
+        grams = {}
+        for i, n in enumerate(lower):
+            for g in set([n[j:j + 3] for j in range(len(n) - 2)]):
+                grams.setdefault(g, []).append(i)
+        keys = sorted(grams)
+        self.gram_keys = np.array(keys, dtype=str)
+        self.gram_ptr = np.r_[0, np.cumsum([len(grams[g]) for g in keys])]
+        self.gram_ids = np.array([i for g in keys for i in grams[g]], dtype=np.int32)
+
+    def gram(self, g):
+        k = np.searchsorted(self.gram_keys, g)
+        if k == len(self.gram_keys) or self.gram_keys[k] != g:
+            return None
+        return self.gram_ids[self.gram_ptr[k]:self.gram_ptr[k + 1]]
+
+    def prefix(self, query, keys, ids):
+        # Keys that start with query lie between query and query with its last
+        # character incremented.
+        end = query[:-1] + chr(ord(query[-1]) + 1)
+        return ids[np.searchsorted(keys, query, side='left'):np.searchsorted(keys, end, side='left')]
+
+    def substring(self, query):
+        grams = sorted([self.gram(query[j:j + 3]) for j in range(len(query) - 2)],
+                       key=lambda g: -1 if g is None else len(g))
+        if grams[0] is None:
+            return np.array([], dtype=np.int32)
+
+        ids = grams[0]
+        for g in grams[1:]:
+            ids = np.intersect1d(ids, g, assume_unique=True)
+        return ids[np.char.find(self.lower[ids], query) >= 0]
+
+    def search(self, query, allowed=None, limit=SEARCH_LIMIT):
+        """
+        :return: A list of up to limit hospital names that match query, best
+                 matches first: names that start with query, then names with a
+                 word or CMS number that starts with query, then names that
+                 contain query (for queries of 3 or more characters). Names with
+                 the same rank are sorted. If allowed (an array of positions in
+                 names) is given, only those hospitals are returned.
+        """
+
+        query = normalize_query(query or '')
+        if query == '':
+            ids = [np.arange(len(self.names), dtype=np.int32)]
+        else:
+            ids = [np.unique(self.prefix(query, keys, key_ids)) for keys, key_ids in self.keys]
+            if len(query) >= 3:
+                ids.append(self.substring(query))
+
+        ids = np.concatenate(ids)
+        if allowed is not None:
+            mask = np.zeros(len(self.names), dtype=bool)
+            mask[allowed] = True
+            ids = ids[mask[ids]]
+
+        # Keep the best rank of each hospital
+        ids = ids[np.sort(np.unique(ids, return_index=True)[1])][:limit]
+        return self.names[ids].tolist()
+
+
+def normalize_query(text):
+    """
+    :return: text in lower case, with runs of whitespace replaced by one space
+             and without leading or trailing whitespace.
+    """
+
+    return ' '.join(text.lower().split())
@@ -0,0 +1,105 @@
+"""
+Files in a directory that are used as a least-recently-used cache: the hospital
+file cache (archive.py), the partitions shared between workers (datasets.py)
+and cached figures (figures.py).
+
+A file's modification time records when it was last used (see touch). Files
+older than a time-to-live, and the least recently used files while the
+directory takes up more than a size limit, are removed by evict. Files are
+written to a temporary file and then renamed, so other threads and workers
+never read a partially written file.
+"""
+
+import os
+import time
+import threading
+
+
+def write_atomic(path, dump, mode='wb'):
+    """
+    Write a file by calling dump with a file object opened for writing, under
+    a temporary name that is then renamed to path.
+    """
+
+    tmp = path + '.' + str(os.getpid()) + '.' + str(threading.get_ident())
+    try:
+        with open(tmp, mode) as f:
+            dump(f)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+class DiskLRU:
+    """
+    The files ending in suffix in directory. Each may have companion files,
+    with the same name but other suffixes (e.g., a json file of metadata),
+    that are removed with it. max_bytes (the size limit of the files ending in
+    suffix) and ttl (seconds since a file was last used) can be None for no
+    limit.
+    """
+
+    def __init__(self, directory, max_bytes=None, ttl=None, suffix='.pkl', companions=()):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.suffix = suffix
+        self.companions = companions
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + self.suffix)
+
+    def touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def entries(self):
+        """
+        :return: A list of (last used time, path, size) of the files.
+        """
+
+        entries = []
+        for e in os.scandir(self.directory):
+            if e.name.endswith(self.suffix):
+                try:
+                    st = e.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, e.path, st.st_size))
+        return entries
+
+    def remove(self, path):
+        base = path[:-len(self.suffix)]
+        for p in [path] + [base + s for s in self.companions]:
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+    def evict(self):
+        """
+        Remove expired files, then the least recently used files until the
+        files fit in max_bytes.
+
+        :return: The number of files removed.
+        """
+
+        now = time.time()
+        entries = sorted(self.entries())
+        total = sum([e[2] for e in entries])
+        removed = 0
+        for mtime, path, size in entries:
+            expired = self.ttl is not None and now - mtime >= self.ttl
+            if not expired and (self.max_bytes is None or total <= self.max_bytes):
+                continue
+            self.remove(path)
+            total -= size
+            removed += 1
+        return removed
@@ -0,0 +1,367 @@
+"""
+Export of the hospital data loaded in the app, for the "Download data" button.
+
+An export holds the columns of the column schema, in its order, followed by the
+other columns of the loaded hospitals (e.g., Facility ID and data url) in the
+order they first appear. Every format keeps the two-row (category,
+sub-category) header of the hospital files: csv files have two header rows, and
+Parquet and Feather files have the pandas metadata that reads their columns
+back as a two-level MultiIndex.
+
+Exports are streamed: hospitals are encoded in batches of EXPORT_BATCH
+hospitals and the encoded bytes are sent as they are written, so a download of
+many hospitals never holds all of their rows, or the whole file, in memory.
+Exports are encoded in one of EXPORT_WORKERS threads, and the request only
+passes the bytes on. To add a format, add its file name,
+label, media type and writer to EXPORT_FORMATS.
+"""
+
+import os
+import ast
+import gzip
+import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from datasets import concat_partitions, load_partitions
+from sparse import LongPartition
+
+
+# Number of hospitals written per batch of an export
+EXPORT_BATCH = int(os.environ.get('HC_EXPORT_BATCH', 50))
+
+# Number of exports that are encoded at the same time; others wait for a thread
+EXPORT_WORKERS = int(os.environ.get('HC_EXPORT_WORKERS', 4))
+
+# Number of hospitals encoded to estimate the size of an export
+EXPORT_SAMPLE = 5
+
+# Encoded bytes are sent in chunks of about this size
+CHUNK_BYTES = 1 << 20
+
+# Number of chunks an encoding thread may get ahead of the download
+QUEUE_CHUNKS = 8
+
+export_pool = ThreadPoolExecutor(max_workers=EXPORT_WORKERS)
+
+ARROW_TYPES = {'int': pa.int64(), 'float': pa.float64(), 'date': pa.timestamp('ns'), 'text': pa.string()}
+PANDAS_TYPES = {'int': 'int64', 'float': 'float64', 'date': 'datetime64[ns]', 'text': object}
+
+
+def parse_cms_list(text):
+    """
+    :return: The CMS numbers in text, a json list sent by the download form.
+             Anything that is not a list of alphanumeric CMS numbers gives an
+             empty list, so a request cannot name other files.
+    """
+
+    try:
+        cms_ls = json.loads(text or '[]')
+    except ValueError:
+        return []
+
+    if not isinstance(cms_ls, list):
+        return []
+    return [cms for cms in cms_ls if isinstance(cms, str) and cms.isalnum()]
+
+
+def export_columns(parts, schema):
+    """
+    :return: The names of the columns of an export of the partitions in parts:
+             the names in schema, then the other columns of parts in the order
+             they first appear.
+    """
+
+    names = list(schema)
+    known = set(names)
+    for p in parts:
+        for c in p.columns:
+            if c not in known:
+                known.add(c)
+                names.append(c)
+    return names
+
+
+def export_types(parts, names):
+    """
+    :return: The type of each column in names when all of parts are joined:
+             'int' if it holds integers in every partition, 'float' if it holds
+             numbers in every partition and floats or missing values in some,
+             'date' if it holds dates and otherwise 'text'. Every batch of an
+             export is written with these types, so that batches agree.
+    """
+
+    kinds = {c: set() for c in names}
+    for p in parts:
+        dtypes = p.frame.dtypes.to_dict() if isinstance(p, LongPartition) else p.dtypes.to_dict()
+        for c in kinds:
+            # Long-format columns are floats and missing columns are NaN
+            kinds[c].add(dtypes[c].kind if c in dtypes else 'f')
+
+    types = {}
+    for c, k in kinds.items():
+        if k <= set('iu'):
+            types[c] = 'int'
+        elif k <= set('iuf'):
+            types[c] = 'float'
+        elif k <= set('Mf'):
+            types[c] = 'date'
+        else:
+            types[c] = 'text'
+    return types
+
+
+def export_frames(parts, names, types, batch):
+    """
+    Generate the rows of parts as DataFrames of batch partitions each, with the
+    columns names (missing columns are empty) and rows numbered as one table.
+    """
+
+    floats = [c for c in names if types[c] == 'float']
+    offset = 0
+    for i in range(0, len(parts), batch):
+        df = concat_partitions(parts[i:i + batch], names).reindex(columns=names)
+        ints = [c for c in floats if df[c].dtype.kind in 'iu']
+        if len(ints) > 0:
+            df[ints] = df[ints].astype(np.float64)
+        df.index = pd.RangeIndex(offset, offset + len(df))
+        offset += len(df)
+        yield df
+
+
+def header_columns(names, pairs):
+    """
+    :return: The (category, sub-category) MultiIndex of the columns names.
+             pairs maps column names to their pair; other names are read as the
+             string form of a pair.
+    """
+
+    return pd.MultiIndex.from_tuples([pairs[n] if n in pairs else ast.literal_eval(n) for n in names])
+
+
+def arrow_schema(names, pairs, types):
+    """
+    :return: The Arrow schema of an export, with the pandas metadata of a
+             DataFrame with the two-level header of the export's columns.
+    """
+
+    empty = pd.DataFrame({i: pd.Series(dtype=PANDAS_TYPES[types[n]]) for i, n in enumerate(names)})
+    empty.columns = header_columns(names, pairs)
+    meta = json.loads(pa.Schema.from_pandas(empty.reset_index(drop=True)).metadata[b'pandas'])
+    # Rows are numbered from 0 when the file is read, as in the csv file
+    meta['index_columns'] = []
+
+    fields = [pa.field(str(c), ARROW_TYPES[types[n]]) for c, n in zip(empty.columns, names)]
+    return pa.schema(fields, metadata={b'pandas': json.dumps(meta).encode()})
+
+
+def arrow_table(df, types, schema):
+    """
+    :return: The rows of df, a DataFrame of export_frames, as an Arrow table
+             with the given schema.
+    """
+
+    arrays = []
+    for c, field in zip(df.columns, schema):
+        values = df[c]
+        if types[c] == 'text':
+            values = values.astype(object)
+            values = values.where(values.isna(), values.astype(str))
+        elif types[c] == 'date':
+            values = pd.to_datetime(values)
+        arrays.append(pa.array(values, type=field.type, from_pandas=True))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def write_csv(out, names, pairs, types, frames):
+    out.write(pd.DataFrame(columns=header_columns(names, pairs)).to_csv().encode())
+    for df in frames:
+        out.write(df.to_csv(header=False).encode())
+
+
+def write_csv_gzip(out, names, pairs, types, frames):
+    with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=6) as f:
+        write_csv(f, names, pairs, types, frames)
+
+
+def write_parquet(out, names, pairs, types, frames):
+    # Each batch is a row group
+    schema = arrow_schema(names, pairs, types)
+    with pq.ParquetWriter(out, schema) as writer:
+        for df in frames:
+            writer.write_table(arrow_table(df, types, schema))
+
+
+def write_feather(out, names, pairs, types, frames):
+    # Feather (version 2) files are Arrow IPC files
+    schema = arrow_schema(names, pairs, types)
+    options = pa.ipc.IpcWriteOptions(compression='lz4')
+    with pa.ipc.new_file(out, schema, options=options) as writer:
+        for df in frames:
+            writer.write_table(arrow_table(df, types, schema))
+
+
+# File name: (label, media type, writer). A writer takes a file-like object,
+# the export's column names, their (category, sub-category) pairs and types,
+# and the DataFrames of export_frames.
+EXPORT_FORMATS = {
+    'data.csv': ('CSV', 'text/csv', write_csv),
+    'data.csv.gz': ('CSV, gzip', 'application/gzip', write_csv_gzip),
+    'data.parquet': ('Parquet', 'application/vnd.apache.parquet', write_parquet),
+    'data.arrow': ('Feather (Arrow)', 'application/vnd.apache.arrow.file', write_feather),
+}
+
+
+class ChunkWriter:
+    """
+    A write-only file that counts the bytes written to it and, if emit is
+    given, passes them on to emit in chunks of about CHUNK_BYTES.
+    """
+
+    def __init__(self, emit=None):
+        self.emit = emit
+        self.buffer = bytearray()
+        self.size = 0
+        self.closed = False
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        self.size += len(data)
+        if self.emit is not None:
+            self.buffer += data
+            if len(self.buffer) >= CHUNK_BYTES:
+                self.flush()
+        return len(data)
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self.emit(bytes(self.buffer))
+            self.buffer = bytearray()
+
+    def tell(self):
+        return self.size
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def close(self):
+        # Writers close their file when they finish; the last chunk is sent
+        # by export_chunks
+        self.closed = True
+
+
+def export_parts(cms_ls, schema):
+    """
+    :return: The partitions of the hospitals in cms_ls that have rows, and the
+             names and types of the columns of their export.
+    """
+
+    parts, failed = load_partitions(cms_ls)
+    parts = [p for p in parts.values() if len(p) > 0]
+    names = export_columns(parts, schema)
+    return parts, names, export_types(parts, names)
+
+
+def export_chunks(name, cms_ls, schema, pairs, batch=EXPORT_BATCH):
+    """
+    Generate the bytes of the export file name (a key of EXPORT_FORMATS) of the
+    hospitals in cms_ls, in chunks. Exports are encoded in a thread of
+    export_pool, which stops if the chunks are no longer wanted (e.g., the
+    download was cancelled), so even an export of one batch is sent as it is
+    written.
+    """
+
+    label, media_type, writer = EXPORT_FORMATS[name]
+    parts, names, types = export_parts(cms_ls, schema)
+
+    def encode(emit):
+        out = ChunkWriter(emit)
+        writer(out, names, pairs, types, export_frames(parts, names, types, batch))
+        out.flush()
+
+    chunks = queue.Queue(QUEUE_CHUNKS)
+    stopped = threading.Event()
+
+    def emit(chunk):
+        while not stopped.is_set():
+            try:
+                chunks.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                pass
+        raise RuntimeError('export stopped')
+
+    def run():
+        try:
+            encode(emit)
+        finally:
+            # None marks the end of the export, or of an export that failed
+            try:
+                emit(None)
+            except RuntimeError:
+                pass
+
+    job = export_pool.submit(run)
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            yield chunk
+        # Raises the error of an export that failed
+        job.result()
+    finally:
+        stopped.set()
+
+
+def export_size(name, cms_ls, rows, schema, pairs, batch=EXPORT_BATCH):
+    """
+    :return: The estimated size in bytes of the export file name of the
+             hospitals in cms_ls, which have rows rows in all. Only up to
+             EXPORT_SAMPLE of the hospitals are loaded and encoded, in one
+             batch and in two, which gives the size of a row and the overhead
+             of a batch (e.g., a Parquet row group), and the size of the
+             export is scaled up from them.
+    """
+
+    label, media_type, writer = EXPORT_FORMATS[name]
+    sample = list(cms_ls)[::max(1, len(cms_ls) // EXPORT_SAMPLE)][:EXPORT_SAMPLE]
+    sample, names, types = export_parts(sample, schema)
+
+    sizes = []
+    for ps, n in [([], 1), (sample, len(sample)), (sample, (len(sample) + 1) // 2)]:
+        out = ChunkWriter()
+        writer(out, names, pairs, types, export_frames(ps, names, types, max(n, 1)))
+        sizes.append(out.size)
+    empty, one, two = sizes
+
+    sample_rows = sum([len(p) for p in sample])
+    if sample_rows == 0:
+        return empty
+
+    overhead = max(two - one, 0) if len(sample) > 1 else 0
+    batches = -(-len(cms_ls) // batch)
+    size = empty + (one - empty - overhead) * rows / sample_rows + overhead * batches
+    return int(max(size, empty))
+
+
+def size_text(size):
+    """
+    :return: A size in bytes as text, e.g., '1.2 MB'.
+    """
+
+    if size < 1000:
+        return str(int(size)) + ' bytes'
+    for unit in ['kB', 'MB', 'GB']:
+        size /= 1000
+        if size < 1000 or unit == 'GB':
+            return ('%.1f' % size) + ' ' + unit
@@ -0,0 +1,146 @@
+"""
+A cache of the figures made by the report callbacks (plots and map).
+
+Figures are keyed by a hash of the callback's inputs, with the df_tab1 handle
+replaced by a fingerprint of the hospitals it holds (see dataset_fingerprint),
+and of the code that makes them, so a deploy does not serve old figures.
+Clicking Run again, or loading the same hospitals and choosing the same
+options in another session, returns the figure from the cache. Figures are
+stored as pickled dicts in a directory that all gunicorn workers can share.
+"""
+
+import os
+import sys
+import json
+import time
+import pickle
+import hashlib
+import functools
+import threading
+import importlib.util
+
+from archive import CACHE_DIR
+from datasets import dataset_fingerprint
+from disk_lru import DiskLRU, write_atomic
+
+
+# Size limit (bytes) of cached figures and the number of seconds a figure is
+# used. Setting HC_FIGURE_CACHE_BYTES to 0 turns the cache off.
+FIGURE_CACHE_DIR = os.environ.get('HC_FIGURE_CACHE_DIR', os.path.join(CACHE_DIR, 'figures'))
+FIGURE_CACHE_BYTES = int(float(os.environ.get('HC_FIGURE_CACHE_BYTES', 200e6)))
+FIGURE_CACHE_TTL = float(os.environ.get('HC_FIGURE_CACHE_TTL', 3600))
+
+# Increase when the figures made by the app change for a reason other than its
+# code (e.g., a new plotly version), so cached figures made before are not
+# used. Changes to the code are covered by code_hash.
+FIGURE_CACHE_VERSION = 2
+
+# Modules whose code, with the module of a cached callback, makes the figures
+FIGURE_MODULES = ['archive', 'datasets', 'sparse', 'sampling', 'scales', 'regression']
+
+
+class FigureCache:
+    """
+    A disk cache of figures keyed by hash. Each entry is a pickle of (creation
+    time, figure dict). Entries older than ttl seconds are not used, and when the
+    entries take up more than max_bytes, the least recently used are deleted.
+    """
+
+    def __init__(self, cache_dir, max_bytes, ttl):
+        self.files = DiskLRU(cache_dir, max_bytes, ttl)
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.counts = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+
+    def get(self, key):
+        """
+        :return: The figure stored under key, or None.
+        """
+
+        path = self.files.path(key)
+        try:
+            with open(path, 'rb') as f:
+                created, figure = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            self.count('misses')
+            return None
+
+        if time.time() - created >= self.ttl:
+            self.count('misses')
+            return None
+
+        self.files.touch(path)
+        self.count('hits')
+        return figure
+
+    def put(self, key, figure):
+        entry = (time.time(), figure)
+        try:
+            write_atomic(self.files.path(key), lambda f: pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL))
+        except OSError as e:
+            print('Could not cache figure:', e)
+            return
+        self.count('evictions', self.files.evict())
+
+
+if FIGURE_CACHE_BYTES > 0:
+    figure_cache = FigureCache(FIGURE_CACHE_DIR, FIGURE_CACHE_BYTES, FIGURE_CACHE_TTL)
+else:
+    figure_cache = None
+
+
+@functools.lru_cache(maxsize=None)
+def code_hash(module):
+    """
+    :return: A hash of the source files of module and FIGURE_MODULES, so that
+             figures cached by a build with other code are not used.
+    """
+
+    h = hashlib.md5()
+    for name in [module] + FIGURE_MODULES:
+        spec = importlib.util.find_spec(name) if name != '__main__' else None
+        path = sys.modules[name].__file__ if spec is None else spec.origin
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def cached_figure(dataset_arg, ignore_args=()):
+    """
+    Decorator for callbacks that return a figure. The figure is cached under a
+    hash of the callback's name and arguments, except that the argument at
+    position dataset_arg (a df_tab1 handle) is replaced by the fingerprint of
+    its dataset and arguments at positions in ignore_args (e.g., n_clicks of a
+    Run button) are left out.
+    """
+
+    def decorator(func):
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            if figure_cache is None:
+                return func(*args)
+
+            key = [FIGURE_CACHE_VERSION, code_hash(func.__module__), func.__name__]
+            for i, a in enumerate(args):
+                if i == dataset_arg:
+                    key.append(dataset_fingerprint(a))
+                elif i not in ignore_args:
+                    key.append(a)
+            key = hashlib.md5(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+            figure = figure_cache.get(key)
+            if figure is None:
+                figure = func(*args)
+                if hasattr(figure, 'to_plotly_json'):
+                    figure = figure.to_plotly_json()
+                figure_cache.put(key, figure)
+            return figure
+
+        return wrapper
+
+    return decorator
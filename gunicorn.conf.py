@@ -0,0 +1,32 @@
+"""
+Gunicorn settings for running the app in production:
+
+    gunicorn -c gunicorn.conf.py app:server
+
+The app is imported once by the master process (preload_app) and workers are
+forked from it. Reference data that never change after startup (the hospital
+directory, column schema, selection arrays and colors) are then shared by all
+workers copy-on-write instead of being loaded again by each worker. Run
+`python worker_memory.py` to compare per-worker memory with and without
+preloading.
+
+Environment variables:
+    WEB_CONCURRENCY: The number of workers (default: 2).
+    HC_PRELOAD: Set to 0 to import the app separately in each worker.
+    PORT: The port to listen on (default: 8000), as set by Heroku.
+"""
+
+import gc
+import os
+
+
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+preload_app = os.environ.get('HC_PRELOAD', '1') != '0'
+
+
+def pre_fork(server, worker):
+    # Objects created while preloading the app are moved out of the garbage
+    # collector's reach, so collections in the workers do not write to (and
+    # copy) the memory pages they are stored in.
+    if preload_app:
+        gc.freeze()
@@ -0,0 +1,34 @@
+"""
+Background jobs for slow callbacks (loading hospital data and the scatter
+plot's regression).
+
+Callbacks registered with app.long_callback run in a process started by the
+long callback manager, so the gunicorn worker that received the request stays
+free to answer other callbacks. The browser polls for the job's progress and
+result, which are kept in a disk cache that all workers share, and a running
+job is cancelled when one of its cancel inputs changes (e.g., the user changes
+the hospital selection while data are loading).
+"""
+
+import os
+
+import diskcache
+from dash.long_callback import DiskcacheLongCallbackManager
+
+from archive import CACHE_DIR
+
+
+JOB_DIR = os.environ.get('HC_JOB_DIR', os.path.join(CACHE_DIR, 'jobs'))
+
+# Seconds that the progress and result of a job are kept for the browser to collect
+JOB_EXPIRE = float(os.environ.get('HC_JOB_EXPIRE', 600))
+
+long_callback_manager = DiskcacheLongCallbackManager(diskcache.Cache(JOB_DIR), expire=JOB_EXPIRE)
+
+
+def load_progress_text(done, total):
+    """
+    :return: Text reporting how many hospitals of a load have been read.
+    """
+
+    return str(done) + '/' + str(total) + ' hospitals loaded'
@@ -0,0 +1,91 @@
+"""
+Polynomial least squares regression for the trendline of the scatter plot
+(update_data_report_plot2).
+
+The fit uses a QR decomposition of the design matrix (1, x, x², ...). The
+diagonal of the hat matrix, i.e. the leverage of each point, is the row sum of
+squares of Q, which gives the standard errors of the fitted mean and of new
+observations without forming (X'X)⁻¹. Results are the same as those of
+statsmodels' OLS and summary_table.
+"""
+
+import numpy as np
+from scipy import stats
+
+
+class PolynomialFit:
+    """
+    The result of fit_polynomial. All arrays are in the order of the x values
+    that were fitted.
+
+    params: Coefficients, starting with the intercept (x⁰).
+    fitted: Fitted values.
+    rsquared, rsquared_adj: R² and adjusted R².
+    mean_ci_low, mean_ci_upp: Confidence interval of the fitted mean.
+    obs_ci_low, obs_ci_upp: Prediction interval of new observations.
+    """
+
+    def __init__(self, params, fitted, rsquared, rsquared_adj,
+                 mean_ci_low, mean_ci_upp, obs_ci_low, obs_ci_upp):
+        self.params = params
+        self.fitted = fitted
+        self.rsquared = rsquared
+        self.rsquared_adj = rsquared_adj
+        self.mean_ci_low = mean_ci_low
+        self.mean_ci_upp = mean_ci_upp
+        self.obs_ci_low = obs_ci_low
+        self.obs_ci_upp = obs_ci_upp
+
+    def outliers(self, y):
+        """
+        :return: A boolean array that is True for values of y outside the
+                 prediction interval.
+        """
+
+        return (y > self.obs_ci_upp) | (y < self.obs_ci_low)
+
+
+def fit_polynomial(x, y, degree=1, alpha=0.05):
+    """
+    Fit y = b0 + b1 x + ... + bd x^d by least squares.
+
+    :return: A PolynomialFit with (1 - alpha) confidence and prediction intervals.
+    """
+
+    x = np.asarray(x, dtype=float).ravel()
+    y = np.asarray(y, dtype=float).ravel()
+    X = np.vander(x, degree + 1, increasing=True)
+    n = X.shape[0]
+
+    Q, R = np.linalg.qr(X)
+
+    # R has the singular values of X, so the rank is found as np.linalg.matrix_rank(X) would
+    sv = np.linalg.svd(R, compute_uv=False)
+    rank = int(np.sum(sv > sv.max() * max(X.shape) * np.finfo(float).eps)) if n > 0 else 0
+    if rank == X.shape[1]:
+        params = np.linalg.solve(R, Q.T @ y)
+        leverage = np.sum(Q ** 2, axis=1)
+    else:
+        # Collinear columns (e.g., too few distinct x values): use the minimum
+        # norm solution, as statsmodels does with its pseudoinverse.
+        U = np.linalg.svd(X, full_matrices=False)[0]
+        params = np.linalg.pinv(X) @ y
+        leverage = np.sum(U[:, :rank] ** 2, axis=1)
+
+    fitted = X @ params
+    resid = y - fitted
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df_resid = np.float64(n - rank)
+        mse = (resid @ resid) / df_resid
+        tss = np.sum((y - np.mean(y)) ** 2)
+        rsquared = 1 - (resid @ resid) / tss
+        rsquared_adj = 1 - (n - 1) / df_resid * (1 - rsquared)
+
+        t = stats.t.isf(alpha / 2, df_resid)
+        se_mean = np.sqrt(mse * leverage)
+        se_obs = np.sqrt(mse * (1 + leverage))
+
+    return PolynomialFit(params, fitted, rsquared, rsquared_adj,
+                         fitted - t * se_mean, fitted + t * se_mean,
+                         fitted - t * se_obs, fitted + t * se_obs)
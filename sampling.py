@@ -0,0 +1,81 @@
+"""
+Limits on the number of points drawn by the scatter/regression plot
+(update_data_report_plot2), and server-side downsampling of its points.
+
+Above PLOT_GL_POINTS points, the plot is drawn with WebGL (Scattergl) and the
+per-hospital traces are merged into one trace, with a color and hover text per
+point. Above PLOT_MAX_POINTS points, the points that are drawn are a sample of
+all points; the trendline and its bands are still fitted to all points.
+Setting either variable to 0 turns that behavior off.
+"""
+
+import os
+
+import numpy as np
+
+
+PLOT_GL_POINTS = int(os.environ.get('HC_PLOT_GL_POINTS', 2000))
+PLOT_MAX_POINTS = int(os.environ.get('HC_PLOT_MAX_POINTS', 10000))
+
+# Number of points used to draw the trendline and bands of a downsampled plot
+PLOT_LINE_POINTS = 1000
+
+# Number of bins along each axis used to sample points
+SAMPLE_BINS = 64
+
+
+def downsample(x, y, max_points, keep=None, bins=SAMPLE_BINS, seed=0):
+    """
+    Choose about max_points of the points (x, y) so that the sample has the same
+    density as all points. The plot area is divided into bins x bins cells and
+    each cell keeps the same fraction of its points, but at least one, so
+    sparse regions and isolated points remain visible. Points are chosen at
+    random with a fixed seed, so the same data give the same sample.
+
+    :return: A boolean array that is True for the points in the sample. Points
+             where keep is True are always in the sample and points with a
+             missing x or y never are.
+    """
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    shown = np.isfinite(x) & np.isfinite(y)
+    if keep is not None:
+        keep = np.asarray(keep, dtype=bool) & shown
+        shown &= ~keep
+
+    n = int(shown.sum())
+    if max_points <= 0 or n <= max_points:
+        return shown if keep is None else shown | keep
+
+    idx = np.flatnonzero(shown)
+    cells = np.zeros(n, dtype=np.int64)
+    for values in [x[idx], y[idx]]:
+        lo, hi = values.min(), values.max()
+        b = np.zeros(n, dtype=np.int64) if hi == lo else ((values - lo) / (hi - lo) * bins).astype(np.int64)
+        cells = cells * bins + np.minimum(b, bins - 1)
+
+    # Rank the points of each cell in random order and keep the first
+    # ceil(fraction * count) of them
+    priority = np.random.default_rng(seed).random(n)
+    order = np.lexsort((priority, cells))
+    cells = cells[order]
+    starts = np.r_[0, np.flatnonzero(np.diff(cells)) + 1]
+    counts = np.diff(np.r_[starts, n])
+    quota = np.maximum(1, np.ceil(counts * (max_points / n))).astype(np.int64)
+    rank = np.arange(n) - np.repeat(starts, counts)
+
+    sample = np.zeros(len(x), dtype=bool)
+    sample[idx[order[rank < np.repeat(quota, counts)]]] = True
+    return sample if keep is None else sample | keep
+
+
+def thin(n, max_points=PLOT_LINE_POINTS):
+    """
+    :return: The indices of about max_points evenly spaced items out of n,
+             including the first and last.
+    """
+
+    if n <= max_points:
+        return np.arange(n)
+    return np.unique(np.linspace(0, n - 1, max_points).round().astype(np.int64))
@@ -0,0 +1,52 @@
+"""
+Axis scales for the scatter/regression plot (update_data_report_plot2).
+
+Each scale has a domain, the values it can transform, and a transform. A
+transform is applied to all values of an axis at once, so a scale that depends
+on the data would see the whole dataset. To add a scale, add its name,
+domain and transform to AXIS_SCALES; it then appears in the plot's scale
+dropdowns. For example, a logit scale for proportions would be:
+
+    'logit': (lambda v: (v > 0) & (v < 1), lambda v: np.log(v / (1 - v))),
+"""
+
+import numpy as np
+
+
+# Scale name: (domain, transform). Both take and return NumPy arrays.
+AXIS_SCALES = {
+    'linear': (None, None),
+    'log10': (lambda v: v > 0, np.log10),
+    'square root': (lambda v: v >= 0, np.sqrt),
+}
+
+
+def scale_axes(x, y, xscale, yscale, *aligned):
+    """
+    Transform x and y values to the given scales. Points with an x or y value
+    outside the domain of its scale are removed.
+
+    :return: The transformed x and y arrays, followed by the arrays in aligned
+             (e.g., dates and names of the points) with the same points removed.
+    """
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    keep = np.ones(len(x), dtype=bool)
+    for values, scale in [(x, xscale), (y, yscale)]:
+        domain, transform = AXIS_SCALES.get(scale, (None, None))
+        if domain is not None:
+            with np.errstate(invalid='ignore'):
+                keep &= domain(values)
+
+    if not keep.all():
+        x, y = x[keep], y[keep]
+        aligned = [np.asarray(a)[keep] for a in aligned]
+
+    scaled = []
+    for values, scale in [(x, xscale), (y, yscale)]:
+        domain, transform = AXIS_SCALES.get(scale, (None, None))
+        scaled.append(values if transform is None else transform(values))
+
+    return tuple(scaled) + tuple(aligned)
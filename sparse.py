@@ -0,0 +1,113 @@
+"""
+Sparse long-format storage of hospital partitions (see datasets.py).
+
+Most (category, sub-category) columns of a hospital's data are empty in most
+file dates, because CMS programs and measures come and go across releases. A
+LongPartition keeps a hospital's float columns as (row, value) pairs of their
+values that are present, sorted by column, so its memory and the size of its
+pickle grow with the number of values rather than with rows x columns. Dense
+columns are built on demand for the few columns a callback needs.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+class LongPartition:
+    """
+    One hospital's data in long format.
+
+    frame: A DataFrame of the columns that are not stored in long format
+           (hospital names, ids, urls, file dates, ...).
+    features: The names of the columns stored in long format.
+    indptr: The values of features[i] are at indptr[i]:indptr[i + 1] in rows
+            and in the values of all blocks, one after the other.
+    rows: The row of each value.
+    values: The values of each block of features (see __init__), one array
+            per block, so float32 columns stay float32 next to float64 ones.
+    block_features: Block b holds features[block_features[b]:block_features[b + 1]].
+    decimals: The number of decimal places that values of each feature are
+              rounded to when they are read (-1 for none), or None.
+    """
+
+    def __init__(self, frame, features, blocks, decimals=None, columns=None):
+        """
+        Store frame as it is and the columns of the 2D float arrays in blocks
+        (e.g., a float32 and a float64 array, or a single array), named
+        features in order, in long format. columns is the order of all
+        columns (default: those of frame, then features).
+        """
+
+        self.frame = frame
+        self.features = list(features)
+        self.attrs = {}
+
+        if isinstance(blocks, np.ndarray):
+            blocks = [blocks]
+        # Each feature's values are contiguous when an array is read by column
+        present = [~np.isnan(block.T) for block in blocks]
+        counts = np.concatenate([p.sum(axis=1) for p in present] + [np.zeros(0, dtype=np.int64)])
+        self.indptr = np.r_[0, np.cumsum(counts)].astype(np.int64)
+        rows = [np.nonzero(p)[1] for p in present]
+        self.rows = np.concatenate(rows + [np.zeros(0, dtype=np.int64)])
+        self.rows = self.rows.astype(np.int16 if len(frame) < 2 ** 15 else np.int32)
+        self.values = [block.T[p] for block, p in zip(blocks, present)]
+        self.block_features = np.r_[0, np.cumsum([block.shape[1] for block in blocks])].astype(np.int64)
+        self.decimals = None if decimals is None else np.asarray(decimals, dtype=np.int8)
+
+        if columns is None:
+            columns = list(frame.columns) + self.features
+        self.columns = pd.Index(columns)
+        self.feature_index = {c: i for i, c in enumerate(self.features)}
+
+    def __len__(self):
+        return len(self.frame)
+
+    @property
+    def shape(self):
+        return len(self.frame), len(self.columns)
+
+    def nbytes(self):
+        """
+        :return: The memory used by the partition, in bytes.
+        """
+
+        arrays = [self.indptr, self.rows, self.block_features] + self.values
+        if self.decimals is not None:
+            arrays.append(self.decimals)
+        return int(self.frame.memory_usage(deep=True).sum()) + sum([a.nbytes for a in arrays])
+
+    def column(self, name):
+        """
+        :return: The values of the column name as a dense array (all missing if
+                 the partition has no such column).
+        """
+
+        if name in self.frame.columns:
+            return self.frame[name].to_numpy()
+
+        dense = np.full(len(self.frame), np.nan)
+        i = self.feature_index.get(name)
+        if i is None:
+            return dense
+
+        span = slice(self.indptr[i], self.indptr[i + 1])
+        b = np.searchsorted(self.block_features, i, side='right') - 1
+        start = self.indptr[self.block_features[b]]
+        values = self.values[b][span.start - start:span.stop - start].astype(np.float64)
+        if self.decimals is not None and self.decimals[i] >= 0:
+            scale = 10.0 ** self.decimals[i]
+            values = np.rint(values * scale) / scale
+        dense[self.rows[span]] = values
+        return dense
+
+    def to_frame(self, columns=None):
+        """
+        :return: A dense DataFrame of the columns in columns (default: all
+                 columns) that the partition has.
+        """
+
+        if columns is None:
+            columns = self.columns
+        data = {c: self.column(c) for c in columns if c in self.columns}
+        return pd.DataFrame(data, index=self.frame.index)
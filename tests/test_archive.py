@@ -0,0 +1,99 @@
+import os
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import archive
+
+
+DATA = os.path.join(os.path.dirname(__file__), 'data')
+
+# Hospitals served by the test server; all of them have the rows of
+# tests/data/hospital_files/010001.csv. Earlier ones take longer to send, so
+# files finish in the reverse of the order they are asked for.
+CMS_NUMBERS = ['010001', '010002', '010003', '010004', '010005', '010006']
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), Handler)
+        with open(os.path.join(DATA, 'hospital_files', '010001.csv'), 'rb') as f:
+            self.data = f.read()
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.requests = 0
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            server.requests += 1
+        try:
+            cms = os.path.basename(self.path)[:-len('.csv')]
+            if cms not in CMS_NUMBERS:
+                self.send_error(404)
+                return
+            time.sleep(0.05 * (len(CMS_NUMBERS) - CMS_NUMBERS.index(cms)))
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(server.data)))
+            self.end_headers()
+            self.wfile.write(server.data)
+        finally:
+            with server.lock:
+                server.active -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """
+    :return: A running Server; hospital files are read from it without the
+             disk cache.
+    """
+
+    monkeypatch.setattr(archive, 'hospital_cache', None)
+    server = Server()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def url(server):
+    return 'http://127.0.0.1:' + str(server.server_address[1]) + '/hospital_files/'
+
+
+def test_frames_are_in_cms_order(server):
+    source = archive.HTTPSource(url(server))
+    frames, failed = archive.fetch_hospital_files(CMS_NUMBERS, source, workers=4)
+    assert failed == []
+    assert [tdf[('data url', 'data url')].iloc[0] for tdf in frames] == \
+        [source.location(cms) for cms in CMS_NUMBERS]
+    assert [len(tdf) for tdf in frames] == [4] * len(CMS_NUMBERS)
+
+
+def test_missing_files_are_failed(server):
+    source = archive.HTTPSource(url(server))
+    frames, failed = archive.fetch_hospital_files(['999998', '010002', '999999'], source, workers=3)
+    assert failed == ['999998', '999999']
+    assert [tdf[('data url', 'data url')].iloc[0] for tdf in frames] == [source.location('010002')]
+
+
+def test_requests_are_limited_to_workers(server):
+    source = archive.HTTPSource(url(server))
+    frames, failed = archive.fetch_hospital_files(CMS_NUMBERS, source, workers=2)
+    assert len(frames) == len(CMS_NUMBERS)
+    assert server.requests == len(CMS_NUMBERS)
+    assert 1 <= server.max_active <= 2
@@ -0,0 +1,87 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import datasets
+
+
+NAME = ('Name and Num', 'Name and Num')
+SCORE = ('HAC', 'Score')
+RATE = ('HAC', 'Rate')
+
+
+@pytest.fixture
+def hospitals(monkeypatch):
+    """
+    :return: The rows of two hospitals, as read from their files: the Score
+             column holds numbers in the first and text in the second.
+    """
+
+    monkeypatch.setattr(datasets, 'FLOAT_POLICY', 'lossless')
+    monkeypatch.setattr(datasets, 'PARTITION_FORMAT', 'wide')
+    a = pd.DataFrame({NAME: ['A'] * 4,
+                      SCORE: [51.152, 0.1, np.nan, 7.25],
+                      RATE: [1.5, 2.5, 3.5, 4.5]})
+    b = pd.DataFrame({NAME: ['B'] * 4,
+                      SCORE: ['Too Few to Report'] * 4,
+                      RATE: [0.3, np.nan, 0.7, 0.9]})
+    return a, b
+
+
+def test_round_trip_with_text_in_one_hospital(hospitals):
+    # Each hospital file is read, and compacted, on its own
+    a, b = hospitals
+    parts = {}
+    for key, tdf in [('a', a), ('b', b)]:
+        made, nbytes = datasets.make_partitions(tdf, [key] * len(tdf))
+        parts.update(made)
+    assert parts['a'][str(SCORE)].dtype == np.float32
+    assert parts['b'][str(SCORE)].dtype == 'category'
+
+    score = str(SCORE)
+    expected = [51.152, 0.1, np.nan, 7.25] + ['Too Few to Report'] * 4
+    for columns in [None, [score, str(RATE)], [score]]:
+        df = datasets.concat_partitions([parts['a'], parts['b']], columns)
+        assert len(df) == 8
+        assert df[score].iloc[:2].tolist() == expected[:2]
+        assert np.isnan(df[score].iloc[2])
+        assert df[score].iloc[3:].tolist() == expected[3:]
+        if columns != [score]:
+            assert df[str(RATE)].dtype == np.float64
+            np.testing.assert_array_equal(df[str(RATE)], [1.5, 2.5, 3.5, 4.5, 0.3, np.nan, 0.7, 0.9])
+
+
+def test_round_trip_of_numbers(hospitals):
+    a, b = hospitals
+    parts, nbytes = datasets.make_partitions(a, ['a'] * 4)
+    df = datasets.concat_partitions(parts.values())
+    assert df[str(SCORE)].dtype == np.float64
+    np.testing.assert_array_equal(df[str(SCORE)], a[SCORE])
+    assert df[str(NAME)].tolist() == ['A'] * 4
+
+
+def test_long_partition_keeps_float32(hospitals, monkeypatch):
+    a, b = hospitals
+    a = a.copy()
+    a[('HAC', 'Third')] = [1 / 3, 2 / 3, np.nan, 1.0]
+    monkeypatch.setattr(datasets, 'PARTITION_FORMAT', 'long')
+    parts, nbytes = datasets.make_partitions(a, ['a'] * 4)
+    assert [v.dtype for v in parts['a'].values] == [np.float32, np.float64]
+
+    df = datasets.concat_partitions(parts.values())
+    for c in [SCORE, RATE, ('HAC', 'Third')]:
+        np.testing.assert_array_equal(df[str(c)], a[c])
+
+
+def test_spilled_datasets_fit_in_disk_bytes(tmp_path):
+    df = pd.DataFrame({str(RATE): np.arange(1000, dtype=np.float64)})
+    store = datasets.DatasetStore(1 << 30, 3600, str(tmp_path), disk_bytes=30000)
+    ids = [store.put(df) for i in range(10)]
+
+    sizes = [e[2] for e in store.files.entries()]
+    assert 0 < sum(sizes) <= 30000
+    assert len(sizes) < 10
+    # The most recent dataset is kept
+    assert os.path.exists(store.path(ids[-1]))
@@ -0,0 +1,70 @@
+import io
+import os
+
+import pandas as pd
+import pytest
+
+import archive
+import datasets
+import export
+
+
+DATA = os.path.join(os.path.dirname(__file__), 'data')
+
+
+@pytest.fixture
+def source(monkeypatch, tmp_path):
+    """
+    :return: A data source reading the hospital files in tests/data, with an
+             empty dataset store.
+    """
+
+    source = archive.DirectorySource(os.path.join(DATA, 'hospital_files'))
+    monkeypatch.setattr(archive, 'data_source', source)
+    monkeypatch.setattr(datasets, 'data_source', source)
+    monkeypatch.setattr(datasets, 'dataset_store', datasets.DatasetStore(1 << 30, 3600, str(tmp_path)))
+    return source
+
+
+def export_csv(cms_ls):
+    """
+    :return: The csv export of the hospitals in cms_ls, with the columns of the
+             bundled schema, as text.
+    """
+
+    columns = archive.load_column_schema()
+    schema = [str(c) for c in columns]
+    pairs = {str(c): c for c in columns}
+    data = b''.join(export.export_chunks('data.csv', cms_ls, schema, pairs))
+    return pd.read_csv(io.BytesIO(data), header=[0, 1], index_col=[0], dtype=str, keep_default_na=False)
+
+
+def test_file_year_is_exported_as_integer(source):
+    df = export_csv(['010001'])
+    assert len(df) == 4
+    assert df[('file_year', 'file_year')].tolist() == ['2020'] * 4
+
+
+def test_csv_export_matches_baseline(source, monkeypatch):
+    # Columns typed as by `python build_data.py schema` from this file, which
+    # declares the columns holding numbers as 'number'
+    kinds = archive.infer_column_kinds([archive.parse_hospital_file(source.location('010001'),
+                                                                    kinds=archive.FIXED_COLUMN_KINDS)])
+    assert 'number' in kinds.values()
+    monkeypatch.setattr(archive, 'column_kinds', lambda: kinds)
+
+    df = export_csv(['010001'])
+    baseline = pd.read_csv(os.path.join(DATA, '010001_baseline.csv'), header=[0, 1], index_col=[0],
+                           dtype=str, keep_default_na=False)
+    assert df.columns.tolist() == baseline.columns.tolist()
+    assert df.index.tolist() == baseline.index.tolist()
+    for c in df.columns:
+        if c in [('Facility ID', 'Facility ID'), ('data url', 'data url')]:
+            # The baseline dropped the leading zeros of Facility IDs, and read
+            # the file over http
+            continue
+        for value, expected in zip(df[c], baseline[c]):
+            if value != expected:
+                # The baseline's numbers went through json, e.g. -0.7010000000000001
+                assert '.' in value and '.' in expected, c
+                assert float(value) == pytest.approx(float(expected)), c
@@ -0,0 +1,164 @@
+"""
+Measure the memory used by each gunicorn worker, with and without preloading
+the app in the master process (see gunicorn.conf.py). Linux only.
+
+Usage:
+    python worker_memory.py [--workers 4] [--port 8123] [--requests 20]
+
+For each mode, gunicorn is started, the app's page and layout and the hospital
+filter callback (which reads the reference data of all hospitals) are requested
+a number of times, and the memory of each worker is read from
+/proc/<pid>/smaps_rollup. Private memory is memory used by that worker alone;
+shared memory is shared with the master process and the other workers.
+"""
+
+import os
+import sys
+import time
+import json
+import signal
+import argparse
+import subprocess
+import urllib.request
+import urllib.error
+
+
+def child_pids(pid):
+    """
+    :return: A list of the process ids of the children of process pid.
+    """
+
+    children = []
+    for d in os.listdir('/proc'):
+        if not d.isdigit():
+            continue
+        try:
+            with open('/proc/' + d + '/stat') as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # The parent id is the second field after the command name
+        if int(stat[stat.rindex(')') + 2:].split()[1]) == pid:
+            children.append(int(d))
+    return sorted(children)
+
+
+def memory(pid):
+    """
+    :return: A dictionary of a process's memory (MB) from /proc/<pid>/smaps_rollup.
+    """
+
+    mem = {}
+    with open('/proc/' + str(pid) + '/smaps_rollup') as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 3 and fields[2] == 'kB':
+                mem[fields[0][:-1]] = int(fields[1]) / 1024
+    mem['Private'] = mem['Private_Clean'] + mem['Private_Dirty']
+    mem['Shared'] = mem['Shared_Clean'] + mem['Shared_Dirty']
+    return mem
+
+
+def find_values(layout, ids, values=None):
+    """
+    :return: A dictionary of the values of the components with the given ids in
+             the app's layout (as returned by /_dash-layout).
+    """
+
+    if values is None:
+        values = {}
+    if isinstance(layout, dict):
+        props = layout.get('props', {})
+        if props.get('id') in ids:
+            values[props['id']] = props.get('value')
+        for v in props.values():
+            find_values(v, ids, values)
+    elif isinstance(layout, list):
+        for v in layout:
+            find_values(v, ids, values)
+    return values
+
+
+def filter_request(url):
+    """
+    :return: A request for the hospital filter callback (update_hospitals), with
+             the default filter values of the app's layout and a search for
+             hospitals with 'medical' in their name.
+    """
+
+    ids = ['beds1', 'states-select1', 'hospital_type1', 'control_type1']
+    layout = json.loads(urllib.request.urlopen(url + '/_dash-layout', timeout=60).read())
+    values = find_values(layout, ids)
+    inputs = [{'id': 'hospital-select1', 'property': 'search_value', 'value': 'medical'}]
+    inputs += [{'id': i, 'property': 'value', 'value': values[i]} for i in ids]
+    body = {'output': 'hospital-select1.options',
+            'outputs': {'id': 'hospital-select1', 'property': 'options'},
+            'inputs': inputs,
+            'changedPropIds': [ids[0] + '.value'],
+            'state': [{'id': 'hospital-select1', 'property': 'value', 'value': None}]}
+    return urllib.request.Request(url + '/_dash-update-component', data=json.dumps(body).encode(),
+                                  headers={'Content-Type': 'application/json'})
+
+
+def measure(preload, args):
+    env = dict(os.environ, HC_PRELOAD='1' if preload else '0', WEB_CONCURRENCY=str(args.workers))
+    proc = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+                             '-b', '127.0.0.1:' + str(args.port), 'app:server'],
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = 'http://127.0.0.1:' + str(args.port)
+
+    try:
+        # Wait until the app answers and every worker has finished importing it,
+        # i.e., the workers' memory has stopped growing.
+        start = time.time()
+        while True:
+            if time.time() - start > args.boot_timeout:
+                raise RuntimeError('gunicorn did not start within ' + str(args.boot_timeout) + ' s')
+            try:
+                urllib.request.urlopen(url, timeout=5).read()
+                break
+            except (urllib.error.URLError, ConnectionError, OSError):
+                time.sleep(0.5)
+
+        rss = None
+        while True:
+            pids = child_pids(proc.pid)
+            new_rss = [memory(pid)['Rss'] for pid in pids]
+            if len(pids) == args.workers and new_rss == rss:
+                break
+            rss = new_rss
+            time.sleep(2)
+
+        request = filter_request(url)
+        for i in range(args.requests):
+            urllib.request.urlopen(url, timeout=60).read()
+            urllib.request.urlopen(url + '/_dash-layout', timeout=60).read()
+            urllib.request.urlopen(request, timeout=60).read()
+
+        return [memory(pid) for pid in child_pids(proc.pid)]
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the memory of gunicorn workers with '
+                                     'and without preloading the app.')
+    parser.add_argument('--workers', type=int, default=4, help='Number of workers (default: 4).')
+    parser.add_argument('--port', type=int, default=8123, help='Port to run gunicorn on (default: 8123).')
+    parser.add_argument('--requests', type=int, default=20, help='Number of times the page, '
+                        'layout and hospital filter are requested before measuring (default: 20).')
+    parser.add_argument('--boot-timeout', type=float, default=120, help='Seconds to wait for '
+                        'gunicorn to start (default: 120).')
+    args = parser.parse_args()
+
+    keys = ['Rss', 'Pss', 'Private', 'Shared']
+    print('%-14s' % 'MB per worker' + ''.join(['%10s' % k for k in keys]))
+    for preload in [False, True]:
+        mems = measure(preload, args)
+        row = ['%10.1f' % (sum([m[k] for m in mems]) / len(mems)) for k in keys]
+        print('%-14s' % ('preload' if preload else 'no preload') + ''.join(row))
+
+
+if __name__ == "__main__":
+    main()